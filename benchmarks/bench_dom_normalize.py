@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# this_file: benchmarks/bench_dom_normalize.py
+"""Cost of the `normalize` backends of kill_tags and translate_no.
+
+Converts every Markdown file of the repository (README, docs, changelogs)
+to HTML, then times each available normalizer on that corpus and a full
+kill_tags + translate_no conversion with each `normalize` value.
+
+    PYTHONPATH=. python benchmarks/bench_dom_normalize.py [root]
+"""
+
+import glob
+import os
+import sys
+import timeit
+
+import lxml.html
+import markdown
+
+from mdx_steroids.dom import NORMALIZERS
+
+EXTENSIONS = ["extra", "mdx_steroids.kill_tags", "mdx_steroids.translate_no"]
+
+
+def corpus(root):
+    texts = []
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.md"), recursive=True)):
+        if "/." not in path:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+    return texts
+
+
+def body_structure(html):
+    body = lxml.html.document_fromstring(html).body
+    return [(el.tag, (el.text or "").strip()) for el in body.iter()]
+
+
+def available(name, normalize):
+    try:
+        normalize("<p>x</p>")
+    except ImportError:
+        print(f"{name:>12}: not installed")
+        return False
+    return True
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else "."
+    texts = corpus(root)
+    docs = [markdown.markdown(text, extensions=["extra"]) for text in texts]
+    size = sum(len(doc) for doc in docs)
+    print(f"{len(docs)} documents, {size / 1024:.0f} KB of HTML\n")
+
+    reference = None
+    print("normalizer only")
+    for name, normalize in NORMALIZERS.items():
+        if not available(name, normalize):
+            continue
+        best = min(
+            timeit.repeat(lambda: [normalize(doc) for doc in docs], number=1, repeat=3)
+        )
+        structure = [body_structure(normalize(doc)) for doc in docs]
+        reference = reference or structure
+        same = sum(a == b for a, b in zip(structure, reference))
+        print(
+            f"{name:>12}: {best * 1e3:8.1f} ms total, "
+            f"{best / len(docs) * 1e3:6.2f} ms/doc, "
+            f"{same}/{len(docs)} documents with the html5lib body structure"
+        )
+
+    print("\nkill_tags + translate_no conversion")
+    for name in ["none"] + list(NORMALIZERS):
+        if name != "none" and not available(name, NORMALIZERS[name]):
+            continue
+        configs = {
+            "mdx_steroids.kill_tags": {"kill": ["del"], "normalize": name},
+            "mdx_steroids.translate_no": {"normalize": name},
+        }
+        md = markdown.Markdown(extensions=EXTENSIONS, extension_configs=configs)
+        best = min(
+            timeit.repeat(
+                lambda: [md.reset().convert(text) for text in texts], number=1, repeat=3
+            )
+        )
+        print(
+            f"{name:>12}: {best * 1e3:8.1f} ms total, "
+            f"{best / len(texts) * 1e3:6.2f} ms/doc"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# this_file: benchmarks/bench_img_smart_parse.py
+"""Per-image parse cost of img_smart image blocks.
+
+Compares the previous parsing code (regexes compiled in `assignExtra`,
+`FIGURES_RE` and `INLINE_LINK_RE` searched several times per block, no
+reuse of the `test()` match) with `MDXSmartImageProcessor.parse_block()`
+and the class-level regexes, on a corpus of 10,000 image blocks.
+
+    PYTHONPATH=. python benchmarks/bench_img_smart_parse.py [count]
+"""
+
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as etree
+
+import markdown
+from markdown.extensions import attr_list
+
+from mdx_steroids.img_smart import MDXSmartImageProcessor
+
+
+def corpus(count):
+    blocks = []
+    for i in range(count):
+        if i % 3 == 0:
+            blocks.append(f"![Screenshot {i}](/img/shot-{i}.png)")
+        elif i % 3 == 1:
+            blocks.append(f'![Photo {i}](/img/photo-{i}.jpg){{: width="{i % 800}" .lores }}')
+        else:
+            blocks.append(f"![Diagram {i}](/img/diagram-{i}.svg){{: data-scale=50% #d{i} }}")
+    return blocks
+
+
+def old_assign_extra(img, attr):
+    image_size = {}
+    BASE_RE = r"\{\:?([^\}]*)\}"
+    INLINE_RE = re.compile(r"^%s" % BASE_RE)
+    NAME_RE = re.compile(MDXSmartImageProcessor.NAME_RE.pattern)
+    m = INLINE_RE.match(attr)
+    if m:
+        for k, v in attr_list.get_attrs(m.group(1)):
+            if k == ".":
+                img.set("class", v)
+            elif k == "data-scale":
+                image_size["scale"] = 1 / int(v.rstrip("%")) * 100
+            else:
+                img.set(NAME_RE.sub("_", k), v)
+    return image_size
+
+
+def old_parse(processor, block):
+    cls = MDXSmartImageProcessor
+    is_image = bool(cls.FIGURES_RE.search(block))  # test()
+    if not (is_image and len(block.splitlines()) == 1):
+        return None
+    alt = url = attr = None
+    md_image = cls.FIGURES_RE.search(block).group(0)
+    if r_alt := cls.FIGURES_RE.search(block):
+        alt = r_alt.group(1)
+    if r_url := cls.INLINE_LINK_RE.search(md_image):
+        url = r_url.group(2)
+    if cls.INLINE_LINK_RE.search(md_image):
+        attr = cls.INLINE_LINK_RE.search(md_image).group(3)
+    if attr:
+        old_assign_extra(etree.Element("img"), attr)
+    return alt, url, attr
+
+
+def new_parse(processor, block):
+    if not processor.test(None, block):  # test() then run() on the same block
+        return None
+    alt, url, attr = processor.parse_block(block)
+    if attr:
+        processor.assignExtra(etree.Element("img"), attr)
+    return alt, url, attr
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    blocks = corpus(count)
+    md = markdown.Markdown()
+    processor = MDXSmartImageProcessor(md.parser, {})
+    assert [old_parse(processor, b) for b in blocks] == [
+        tuple(new_parse(processor, b)) for b in blocks
+    ]
+    for name, parse in (("before", old_parse), ("after", new_parse)):
+        best = min(
+            timeit.repeat(
+                lambda: [parse(processor, b) for b in blocks], number=1, repeat=5
+            )
+        )
+        print(f"{name:>6}: {best * 1e3:8.1f} ms total, {best / count * 1e6:6.2f} µs/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# this_file: benchmarks/bench_md_mako_escape.py
+"""Cost of the md_mako text handling around Mako, on a 5 MB templated document.
+
+Compares the former implementation (three multiline substitutions for
+`#`, `{%` and `%}`, a list copy for the `include_auto` line and a sliced
+copy of the rendered lines) with the current one (one combined pattern
+with a callback, one join and an in-place deletion). Reports the best
+time and the peak of allocated memory of each.
+
+    PYTHONPATH=. python benchmarks/bench_md_mako_escape.py [megabytes]
+"""
+
+import itertools
+import re
+import sys
+import timeit
+import tracemalloc
+
+from mdx_steroids.md_mako import MakoPreprocessor
+
+PAGE = """\
+## Section ${n}
+
+Text of section ${n}, written by ${author}, with *emphasis* and `code`.
+
+% for item in items:
+- ${item} in section ${n}
+% endfor
+
+### Notes
+
+{%
+Literal text between braces.
+%}
+
+"""
+INCLUDE = '<%include file="head.md"/>'
+
+re1 = re.compile(r"^([#]+)", re.M)
+re2 = re.compile(r"^({%)", re.M)
+re3 = re.compile(r"^(%})", re.M)
+
+
+def escape_before(text):
+    text = re1.sub(r"${'\1'}", text)
+    text = re2.sub(r"${'\1'}", text)
+    return re3.sub(r"${'\1'}", text)
+
+
+def lines_before(lines, rendered):
+    text = "\n".join([INCLUDE] + lines)
+    return text, rendered.splitlines()[1:]
+
+
+def lines_after(lines, rendered):
+    text = "\n".join(itertools.chain((INCLUDE,), lines))
+    result = rendered.splitlines()
+    del result[:1]
+    return text, result
+
+
+def measure(fn, *args):
+    best = min(timeit.repeat(lambda: fn(*args), number=1, repeat=5))
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def report(label, before, after):
+    (t0, m0), (t1, m1) = before, after
+    print(
+        f"{label:>10}: {t0 * 1e3:7.1f} ms, {m0 / 1e6:6.1f} MB peak  ->  "
+        f"{t1 * 1e3:7.1f} ms, {m1 / 1e6:6.1f} MB peak  ({t0 / t1:.1f}x faster)"
+    )
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    count = int(megabytes * 1e6 / len(PAGE))
+    text = "".join(PAGE.replace("${n}", str(n)) for n in range(count))
+    lines = text.split("\n")
+    print(f"{len(text) / 1e6:.1f} MB, {len(lines)} lines\n")
+
+    assert escape_before(text) == MakoPreprocessor.keep_markdown_headings(text)
+    report(
+        "escape",
+        measure(escape_before, text),
+        measure(MakoPreprocessor.keep_markdown_headings, text),
+    )
+    report(
+        "lines",
+        measure(lines_before, lines, text),
+        measure(lines_after, lines, text),
+    )
+
+
+if __name__ == "__main__":
+    main()
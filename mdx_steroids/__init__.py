@@ -15,5 +15,12 @@ __all__ = [
     "comments",
     "interlink",
     "img_smart",
+    "img_cache",
+    "img_probe",
+    "img_fetch",
+    "img_manifest",
+    "dom",
+    "batch",
+    "cli",
     "__version__",
 ]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/batch.py
+"""Batch conversion of many documents with one extension configuration.
+
+Setting up a `markdown.Markdown` instance runs the setup of every
+extension: compiling regexes and selectors, merging key maps, creating
+Mako lookups. `MarkdownPool` keeps configured instances and resets them
+between documents, so that cost is paid once per instance instead of
+once per document. `convert_many()` converts a stream of documents with
+a pool, in the current process or across a `ProcessPoolExecutor` whose
+workers each set up their own pool once.
+
+```python
+from pathlib import Path
+
+from mdx_steroids.batch import convert_many
+
+paths = sorted(Path("docs").rglob("*.md"))
+results = convert_many(paths, ["mdx_steroids.kill_tags"], workers=4)
+for path, html in zip(paths, results):
+    path.with_suffix(".html").write_text(html, encoding="utf-8")
+```
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import collections
+import contextlib
+import os
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import markdown
+
+Source = Union[str, "os.PathLike[str]"]
+
+WINDOW_PER_WORKER = 4
+
+
+def read_source(source: Source) -> str:
+    """Return the text of `source`: a path-like object is read, a string is the text."""
+    if isinstance(source, os.PathLike):
+        with open(source, encoding="utf-8") as f:
+            return f.read()
+    return source
+
+
+class MarkdownPool:
+    """Configured `Markdown` instances, reused between documents.
+
+    Instances are created on demand, so a pool used from several threads
+    holds one instance per concurrent conversion.
+
+    Args:
+        extensions: Extension names or instances, as for `markdown.Markdown`
+        extension_configs: Extension configurations, keyed by extension name
+        **kwargs: Other `markdown.Markdown` options, such as `output_format`
+    """
+
+    def __init__(
+        self,
+        extensions: Sequence[Any] = (),
+        extension_configs: Optional[Dict[str, Dict[str, Any]]] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.extensions = list(extensions)
+        self.extension_configs = extension_configs or {}
+        self.kwargs = kwargs
+        self._idle: "queue.LifoQueue[markdown.Markdown]" = queue.LifoQueue()
+
+    def create(self) -> markdown.Markdown:
+        return markdown.Markdown(
+            extensions=self.extensions,
+            extension_configs=self.extension_configs,
+            **self.kwargs,
+        )
+
+    @contextlib.contextmanager
+    def markdown(self) -> Iterator[markdown.Markdown]:
+        """Borrow a reset instance for one conversion."""
+        try:
+            md = self._idle.get_nowait()
+        except queue.Empty:
+            md = self.create()
+        try:
+            yield md.reset()
+        finally:
+            self._idle.put(md)
+
+    def convert(self, source: Source) -> str:
+        with self.markdown() as md:
+            return md.convert(read_source(source))
+
+
+_worker_pool: Optional[MarkdownPool] = None
+
+
+def _init_worker(
+    extensions: Sequence[Any],
+    extension_configs: Dict[str, Dict[str, Any]],
+    kwargs: Dict[str, Any],
+) -> None:
+    global _worker_pool
+    _worker_pool = MarkdownPool(extensions, extension_configs, **kwargs)
+    _worker_pool._idle.put(_worker_pool.create())  # set up before the first document
+
+
+def _convert_in_worker(source: Source) -> str:
+    if _worker_pool is None:
+        raise RuntimeError("worker not initialized: call _init_worker() first")
+    return _worker_pool.convert(source)
+
+
+def convert_many(
+    sources: Iterable[Source],
+    extensions: Sequence[Any] = (),
+    extension_configs: Optional[Dict[str, Dict[str, Any]]] = None,
+    workers: int = 1,
+    **kwargs: Any,
+) -> Iterator[str]:
+    """Convert many documents with one configuration, yielding HTML in input order.
+
+    Args:
+        sources: Documents; path-like objects (such as `pathlib.Path`) are
+            read as UTF-8 files, in the worker, and strings are Markdown text
+        extensions: Extension names or instances; with `workers` > 1 they
+            must be picklable, so prefer names
+        extension_configs: Extension configurations, keyed by extension name
+        workers: Number of worker processes; 1 converts in this process
+        **kwargs: Other `markdown.Markdown` options
+
+    Yields:
+        The HTML of each document, as soon as it and all documents before it
+        are converted
+    """
+    extension_configs = extension_configs or {}
+    if workers <= 1:
+        pool = MarkdownPool(extensions, extension_configs, **kwargs)
+        for source in sources:
+            yield pool.convert(source)
+        return
+
+    yield from map_ordered(
+        _convert_in_worker,
+        sources,
+        workers,
+        _init_worker,
+        (list(extensions), extension_configs, kwargs),
+    )
+
+
+def map_ordered(
+    fn: Callable[[Any], Any],
+    items: Iterable[Any],
+    workers: int,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: Tuple[Any, ...] = (),
+) -> Iterator[Any]:
+    """Apply `fn` to `items` in worker processes, yielding results in input order.
+
+    At most `WINDOW_PER_WORKER` items per worker are in flight, so long
+    streams of items are neither read ahead nor buffered in full.
+    """
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending: "collections.deque[Future[Any]]" = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers * WINDOW_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/cli.py
+"""The `mdx-steroids` command-line tool.
+
+`mdx-steroids build` converts every Markdown file of a source tree to an
+HTML file of the same relative path in an output directory, across a
+process pool, and prints throughput statistics:
+
+```bash
+mdx-steroids build docs -c steroids.yml -o site -j 8
+```
+
+The configuration file is YAML in one of the shapes already used for
+these extensions: a mapping of extension name to options (as for
+`python -m markdown -c`), a list of names or single-key mappings (as
+`markdown_extensions` in `mkdocs.yml`), or a whole `mkdocs.yml`:
+
+```yaml
+mdx_steroids.kill_tags:
+  kill: [del]
+mdx_steroids.keys:
+  camel_case: true
+```
+
+Each worker process sets up its extensions once (key map merge, selector
+compilation, Mako lookups) and reuses the `Markdown` instance for all of
+its documents. Files are converted in sorted order and written by the
+workers; results are collected in that order, so the output and the
+report do not depend on scheduling.
+
+The report gives documents and megabytes of Markdown per second of wall
+time, and the time spent in the processors of each extension, summed over
+the workers. Time outside extension processors (the core parser and
+serializer) is reported as `markdown`.
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import argparse
+import functools
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import markdown
+import yaml
+
+from .batch import MarkdownPool, map_ordered
+
+SUFFIXES = (".md", ".markdown")
+CORE = "markdown"
+
+Configs = Dict[str, Dict[str, Any]]
+Timings = Dict[str, float]
+
+
+def load_config(path: str) -> Tuple[List[str], Configs]:
+    """Read extension names and configurations from a YAML file."""
+    with open(path, encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    if isinstance(data, dict) and "markdown_extensions" in data:
+        data = data["markdown_extensions"] or []
+    if isinstance(data, dict):
+        data = [{name: options} for name, options in data.items()]
+    if not isinstance(data, list):
+        raise ValueError(f"{path}: expected a mapping or a list of extensions")
+    extensions: List[str] = []
+    configs: Configs = {}
+    for item in data:
+        if isinstance(item, dict):
+            ((name, options),) = item.items()
+        else:
+            name, options = item, None
+        extensions.append(name)
+        configs[name] = options or {}
+    return extensions, configs
+
+
+class Profiler:
+    """Accumulates the exclusive time spent in wrapped callables, by label."""
+
+    def __init__(self) -> None:
+        self.timings: Timings = {}
+        self._stack: List[float] = []  # time spent in nested calls, per level
+
+    def wrap(self, label: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            self._stack.append(0.0)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                nested = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += elapsed
+                self.timings[label] = self.timings.get(label, 0.0) + elapsed - nested
+
+        return timed
+
+    def take(self) -> Timings:
+        timings, self.timings = self.timings, {}
+        return timings
+
+
+def _processors(md: markdown.Markdown) -> Iterator[Tuple[Any, str]]:
+    """Yield every registered processor with the name of its timed method."""
+    for registry in (md.preprocessors, md.parser.blockprocessors, md.treeprocessors):
+        for processor in registry:
+            yield processor, "run"
+    for pattern in md.inlinePatterns:
+        yield pattern, "handleMatch"
+    for processor in md.postprocessors:
+        yield processor, "run"
+
+
+class ProfilingPool(MarkdownPool):
+    """Pool whose instances time the processors added by each extension.
+
+    Extensions are registered one by one, and every processor that appears
+    after an extension is registered is attributed to it. A processor shared
+    by several extensions, such as the DOM stage of kill_tags and
+    translate_no, is attributed to the first one.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.profiler = Profiler()
+
+    def create(self) -> markdown.Markdown:
+        md = markdown.Markdown(**self.kwargs)
+        seen = {id(processor) for processor, _ in _processors(md)}
+        for extension in self.extensions:
+            md.registerExtensions([extension], self.extension_configs)
+            if isinstance(extension, str):
+                label = extension
+            else:
+                label = type(extension).__module__
+            for processor, method in _processors(md):
+                if id(processor) not in seen:
+                    seen.add(id(processor))
+                    timed = self.profiler.wrap(label, getattr(processor, method))
+                    setattr(processor, method, timed)
+        return md
+
+
+_worker_pool: Optional[ProfilingPool] = None
+
+
+def _init_worker(extensions: Sequence[str], configs: Configs) -> None:
+    global _worker_pool
+    _worker_pool = ProfilingPool(extensions, configs)
+    _worker_pool._idle.put(_worker_pool.create())
+
+
+def _build_one(item: Tuple[str, str]) -> Tuple[int, Timings]:
+    """Convert one file; return the size of its source and its timings."""
+    if _worker_pool is None:
+        raise RuntimeError("worker not initialized: call _init_worker() first")
+    source, target = item
+    target = os.path.splitext(target)[0] + ".html"
+    with open(source, encoding="utf-8") as f:
+        text = f.read()
+    _worker_pool.profiler.take()
+    started = time.perf_counter()
+    html = _worker_pool.convert(text)
+    elapsed = time.perf_counter() - started
+    timings = _worker_pool.profiler.take()
+    timings[CORE] = elapsed - sum(timings.values())
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "w", encoding="utf-8") as f:
+        f.write(html)
+    return len(text.encode("utf-8")), timings
+
+
+def iter_sources(root: str, suffixes: Sequence[str] = SUFFIXES) -> Iterator[str]:
+    """Yield the Markdown files below `root` in sorted order."""
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.lower().endswith(tuple(suffixes)) and not name.startswith("."):
+                yield os.path.join(folder, name)
+
+
+def build(
+    root: str,
+    output: str,
+    extensions: Sequence[str],
+    configs: Configs,
+    workers: int = 1,
+    suffixes: Sequence[str] = SUFFIXES,
+) -> Tuple[int, int, Timings]:
+    """Convert every Markdown file below `root` into `output`.
+
+    Returns:
+        The number of documents, the total size of their sources in bytes,
+        and the seconds spent per extension, summed over the workers
+    """
+    items = (
+        (path, os.path.join(output, os.path.relpath(path, root)))
+        for path in iter_sources(root, suffixes)
+    )
+    if workers <= 1:
+        _init_worker(extensions, configs)
+        results: Iterator[Tuple[int, Timings]] = map(_build_one, items)
+    else:
+        results = map_ordered(
+            _build_one, items, workers, _init_worker, (list(extensions), configs)
+        )
+    docs, nbytes = 0, 0
+    totals: Timings = {}
+    for size, timings in results:
+        docs += 1
+        nbytes += size
+        for label, seconds in timings.items():
+            totals[label] = totals.get(label, 0.0) + seconds
+    return docs, nbytes, totals
+
+
+def report(
+    docs: int, nbytes: int, totals: Timings, elapsed: float, workers: int
+) -> str:
+    """Format the throughput and the time per extension of a build."""
+    elapsed = max(elapsed, 1e-9)
+    megabytes = nbytes / 1e6
+    lines = [
+        f"{docs} docs, {megabytes:.2f} MB in {elapsed:.2f} s with {workers} workers: "
+        f"{docs / elapsed:.1f} docs/s, {megabytes / elapsed:.2f} MB/s"
+    ]
+    busy = sum(totals.values()) or 1.0
+    width = max((len(label) for label in totals), default=0)
+    for label, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+        share = 100 * seconds / busy
+        lines.append(f"  {label:<{width}}  {seconds:8.3f} s  {share:5.1f}%")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="mdx-steroids", description="Tools for the mdx_steroids extensions."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser(
+        "build", help="convert a tree of Markdown files to HTML"
+    )
+    build_parser.add_argument("root", help="source directory")
+    build_parser.add_argument(
+        "-c", "--config", help="YAML file with extensions and their options"
+    )
+    build_parser.add_argument("-o", "--output", required=True, help="output directory")
+    build_parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes (default: CPU count)",
+    )
+    build_parser.add_argument(
+        "--suffix",
+        action="append",
+        dest="suffixes",
+        help="source file suffix, may be repeated (default: .md and .markdown)",
+    )
+    args = parser.parse_args(argv)
+
+    extensions, configs = load_config(args.config) if args.config else ([], {})
+    started = time.perf_counter()
+    docs, nbytes, totals = build(
+        args.root,
+        args.output,
+        extensions,
+        configs,
+        args.workers,
+        tuple(args.suffixes or SUFFIXES),
+    )
+    elapsed = time.perf_counter() - started
+    summary = report(docs, nbytes, totals, elapsed, args.workers)
+    print(f"{args.output}: {summary}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
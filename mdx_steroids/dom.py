@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/dom.py
+"""Shared lxml DOM stage for the HTML postprocessing extensions.
+
+`mdx_steroids.kill_tags` and `mdx_steroids.translate_no` both work on
+the final HTML as an lxml tree. Instead of each parsing and serializing
+the whole document (and, with `normalize`, passing it twice through a
+normalizing parser), they register a `DomProcessor` with the `DomStage`
+postprocessor of the `Markdown` instance. The stage parses the HTML once
+per conversion, runs every registered processor on the same tree in
+priority order, and serializes it once at the end.
+
+Selectors are compiled with `compile_selector()` into `lxml.etree.XPath`
+objects held in a process-wide LRU cache keyed by the selector string, so
+each selector is translated and compiled once per process, not once per
+document. `compile_union()` merges a list of selectors into one XPath, so
+they are matched in a single query that returns each element once, in
+document order.
+
+`parse_simple()` parses the CSS selectors that can be tested on a single
+element and its ancestors (type, class, id and attribute selectors joined
+by descendant or child combinators) into `SimpleSelector`s, which a
+`SelectorMatcher` tests on both lxml and `xml.etree` elements without
+building an XPath.
+
+`compile_prefilter()` turns the selectors into one regular expression
+that every HTML string with a possible match contains, such as `<del` for
+`del` or `language-del` for `code.language-del`. The DOM stage searches the
+raw HTML with it first, and returns documents without any possible match
+unchanged, without parsing them.
+
+The `normalize` option selects a backend from `NORMALIZERS`: `html5lib`
+(BeautifulSoup with html5lib, the slowest; also chosen by `true`), `lxml`,
+`html5-parser` (needs the `html5-parser` package) or `none` (also chosen by
+`false`). Each returns a complete, well-formed `<html>` document with all
+tags balanced. BeautifulSoup, html5lib and html5-parser are only imported
+when their backend is used.
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import functools
+import re
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import cssselect.parser as cssparser
+import lxml.cssselect as cssselect
+import lxml.etree as et
+import lxml.html
+from future.utils import bytes_to_native_str as n
+from markdown import Markdown
+from markdown.postprocessors import Postprocessor
+from markdown.util import Registry
+
+STAGE_NAME = "steroids_dom"
+STAGE_PRIORITY = 5
+SELECTOR_CACHE_SIZE = 1024
+
+_translator = cssselect.LxmlHTMLTranslator()
+
+
+def selector_to_xpath(selector: str) -> str:
+    """Translate a CSS selector, or an XPath selector with the "!" prefix."""
+    if selector[:1] == "!":  # direct XPath selector
+        return selector[1:]
+    return _translator.css_to_xpath(selector)  # CSS selector
+
+
+@functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def compile_selector(selector: str) -> et.XPath:
+    """Return the compiled XPath for `selector`, cached per process."""
+    return et.XPath(selector_to_xpath(selector))
+
+
+@functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def compile_union(selectors: Tuple[str, ...]) -> Optional[et.XPath]:
+    """Return one compiled XPath matching any of `selectors`, or None if empty."""
+    if not selectors:
+        return None
+    return et.XPath(" | ".join(f"({selector_to_xpath(sel)})" for sel in selectors))
+
+
+Attrib = Tuple[str, str, Optional[str]]
+
+
+def _attrib_matches(actual: Optional[str], operator: str, value: Optional[str]) -> bool:
+    if operator == "!=":
+        return actual != value
+    if actual is None:
+        return False
+    if operator == "exists":
+        return True
+    if operator == "=":
+        return actual == value
+    if operator == "~=":
+        return value in actual.split()
+    if operator == "|=":
+        return actual == value or actual.startswith(value + "-")
+    if operator == "^=":
+        return bool(value) and actual.startswith(value)
+    if operator == "$=":
+        return bool(value) and actual.endswith(value)
+    if operator == "*=":
+        return bool(value) and value in actual
+    return False
+
+
+class Compound(NamedTuple):
+    """A compound selector such as `code.language-del#x[lang]`."""
+
+    tag: Optional[str]  # None matches any tag
+    id: Optional[str]
+    classes: FrozenSet[str]
+    attribs: Tuple[Attrib, ...]
+
+    def matches(self, el) -> bool:
+        if self.tag is not None and el.tag != self.tag:
+            return False
+        if self.id is not None and el.get("id") != self.id:
+            return False
+        if self.classes and not self.classes.issubset(el.get("class", "").split()):
+            return False
+        return all(
+            _attrib_matches(el.get(name), operator, value)
+            for name, operator, value in self.attribs
+        )
+
+
+class SimpleSelector(NamedTuple):
+    """A chain of compounds joined by descendant (" ") or child (">") combinators.
+
+    `ancestors` holds the `(combinator, compound)` pairs left of `subject`,
+    nearest first.
+    """
+
+    subject: Compound
+    ancestors: Tuple[Tuple[str, Compound], ...]
+
+    def matches(self, el, ancestors: Sequence = ()) -> bool:
+        """Test `el`, given its ancestors nearest first (needed for chains)."""
+        return self.subject.matches(el) and self._match_chain(0, ancestors, 0)
+
+    def _match_chain(self, i: int, ancestors: Sequence, j: int) -> bool:
+        if i == len(self.ancestors):
+            return True
+        combinator, compound = self.ancestors[i]
+        if combinator == ">":
+            return (
+                j < len(ancestors)
+                and compound.matches(ancestors[j])
+                and self._match_chain(i + 1, ancestors, j + 1)
+            )
+        return any(
+            compound.matches(ancestors[k]) and self._match_chain(i + 1, ancestors, k + 1)
+            for k in range(j, len(ancestors))
+        )
+
+
+def _compound(tree) -> Optional[Compound]:
+    tag = id_ = None
+    classes = []
+    attribs = []
+    while not isinstance(tree, cssparser.Element):
+        if isinstance(tree, cssparser.Class):
+            classes.append(tree.class_name)
+        elif isinstance(tree, cssparser.Hash):
+            id_ = tree.id
+        elif isinstance(tree, cssparser.Attrib) and not tree.namespace and not tree.flag:
+            value = None if tree.value is None else tree.value.value
+            attribs.append((tree.attrib, tree.operator, value))
+        else:  # pseudo-classes, negation, functions
+            return None
+        tree = tree.selector
+    if tree.namespace:
+        return None
+    if tree.element is not None:
+        tag = tree.element.lower()
+    return Compound(tag, id_, frozenset(classes), tuple(attribs))
+
+
+@functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def parse_simple(selector: str) -> Optional[Tuple[SimpleSelector, ...]]:
+    """Parse a CSS selector group into `SimpleSelector`s.
+
+    Returns None for XPath ("!") selectors and for CSS selectors that need
+    more than the element and its ancestors: sibling combinators,
+    pseudo-classes and pseudo-elements, namespaces.
+    """
+    if selector[:1] == "!":
+        return None
+    try:
+        parsed = cssparser.parse(selector)
+    except cssparser.SelectorError:
+        return None
+    result: List[SimpleSelector] = []
+    for sel in parsed:
+        if sel.pseudo_element is not None:
+            return None
+        tree = sel.parsed_tree
+        chain = []
+        while isinstance(tree, cssparser.CombinedSelector):
+            if tree.combinator not in (" ", ">"):
+                return None
+            right = _compound(tree.subselector)
+            if right is None:
+                return None
+            chain.append((tree.combinator, right))
+            tree = tree.selector
+        left = _compound(tree)
+        if left is None:
+            return None
+        # chain holds (combinator, right-hand compound) pairs, subject first
+        compounds = [c for _, c in chain] + [left]
+        combinators = [comb for comb, _ in chain]
+        result.append(
+            SimpleSelector(compounds[0], tuple(zip(combinators, compounds[1:])))
+        )
+    return tuple(result)
+
+
+class SelectorMatcher:
+    """Test elements against many `SimpleSelector`s, indexed by subject tag.
+
+    Works on lxml elements and on `xml.etree` elements, such as the tree
+    of Python-Markdown, which have no parent links.
+    """
+
+    def __init__(self, selectors: Iterable[SimpleSelector]) -> None:
+        self.by_tag: Dict[Optional[str], List[SimpleSelector]] = {}
+        for selector in selectors:
+            self.by_tag.setdefault(selector.subject.tag, []).append(selector)
+        self.chained = any(
+            sel.ancestors for group in self.by_tag.values() for sel in group
+        )
+
+    def matches(self, el, ancestors: Callable[[], Sequence]) -> bool:
+        """Test `el`; `ancestors()` returns its ancestors, nearest first."""
+        if not isinstance(el.tag, str):  # comment or processing instruction
+            return False
+        candidates = self.by_tag.get(el.tag, []) + self.by_tag.get(None, [])
+        found: Sequence = ()
+        for selector in candidates:
+            if selector.ancestors and not found:
+                found = ancestors()
+            if selector.matches(el, found):
+                return True
+        return False
+
+    def iter_matches(self, root) -> Iterable:
+        """Yield the matching elements below `root`, in document order."""
+        parents = {}
+        if self.chained:
+            parents = {child: parent for parent in root.iter() for child in parent}
+
+        def ancestors(el):
+            result = []
+            while el in parents:
+                el = parents[el]
+                result.append(el)
+            return result
+
+        for el in root.iter():
+            if el is not root and self.matches(el, lambda: ancestors(el)):
+                yield el
+
+
+def selector_hint(selector: str) -> Optional[str]:
+    """Return a regex found in any HTML where `selector` matches, or None.
+
+    Only the subject of each selector is used: its id, else its longest
+    class, its tag (`<del`) or an attribute name. None means any HTML may
+    match.
+    """
+    parsed = parse_simple(selector)
+    if parsed is None:
+        return None
+    hints = []
+    for sel in parsed:
+        subject = sel.subject
+        if subject.id is not None:
+            hints.append(re.escape(subject.id))
+        elif subject.classes:
+            hints.append(re.escape(max(subject.classes, key=len)))
+        elif subject.tag is not None:
+            hints.append(r"<{}(?=[\s/>])".format(re.escape(subject.tag)))
+        elif subject.attribs:
+            hints.append(re.escape(subject.attribs[0][0]))
+        else:  # universal selector
+            return None
+    return "|".join(hints)
+
+
+@functools.lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def compile_prefilter(
+    selectors: Tuple[str, ...], empty_tags: Tuple[str, ...] = ()
+) -> Optional[Pattern]:
+    """Return a regex found in any HTML where a selector can match, or None.
+
+    Args:
+        selectors: CSS selectors; with an XPath or universal selector
+            among them, no prefilter can be built and None is returned
+        empty_tags: Tags removed when empty. An element that may be empty
+            once parsed has no attributes, and its content starts with
+            optional whitespace followed by markup, which includes start
+            tags that close it implicitly, a character reference such as
+            `&#32;`, or the end of the document
+    """
+    hints = []
+    for selector in selectors:
+        hint = selector_hint(selector)
+        if hint is None:
+            return None
+        hints.append(hint)
+    if empty_tags:
+        tags = "|".join(re.escape(tag) for tag in empty_tags)
+        hints.append(r"<(?:{})\s*/?>\s*(?:[<&]|$)".format(tags))
+    return re.compile("|".join(hints) or "(?!)", re.IGNORECASE)
+
+
+class DomProcessor(Postprocessor):
+    """A postprocessor that modifies the lxml tree of the final HTML.
+
+    Subclasses implement `run_tree()`. Registered with `get_dom_stage()`,
+    they share one parse and one serialization per conversion; `run()`
+    keeps them usable as ordinary postprocessors on their own. Subclasses
+    that set `prefilter` (see `compile_prefilter()`) are skipped for
+    documents in which it finds nothing.
+    """
+
+    config: dict = {}
+    prefilter: Optional[Pattern] = None
+    raw_html_only = False
+
+    def may_match(self, html: str) -> bool:
+        """Tell if the selectors may match in `html`.
+
+        With `raw_html_only`, set when a treeprocessor already handled the
+        Markdown tree, only the raw HTML blocks of the document are searched.
+        """
+        if self.raw_html_only:
+            return any(
+                not isinstance(block, str) or self._search(block)
+                for block in self.md.htmlStash.rawHtmlBlocks
+            )
+        return self._search(html)
+
+    def _search(self, html: str) -> bool:
+        return self.prefilter is None or self.prefilter.search(html) is not None
+
+    def run_tree(self, tree: lxml.html.HtmlElement) -> None:
+        raise NotImplementedError
+
+    def run(self, html: str) -> str:
+        if not self.may_match(html):
+            return html
+        return process_html(html, [self])
+
+
+def normalize_html5lib(html: str) -> str:
+    from bs4 import BeautifulSoup
+
+    return str(BeautifulSoup(html, "html5lib"))
+
+
+def normalize_lxml(html: str) -> str:
+    return lxml.html.tostring(lxml.html.document_fromstring(html), encoding="unicode")
+
+
+def normalize_html5_parser(html: str) -> str:
+    import html5_parser
+
+    root = html5_parser.parse(html, treebuilder="lxml")
+    return et.tostring(root, encoding="unicode", method="html")
+
+
+NORMALIZERS: Dict[str, Callable[[str], str]] = {
+    "html5lib": normalize_html5lib,
+    "lxml": normalize_lxml,
+    "html5-parser": normalize_html5_parser,
+}
+
+
+def normalizer(option: Union[bool, str, None]) -> Optional[Callable[[str], str]]:
+    """Return the normalizer selected by a `normalize` option value, or None.
+
+    Raises:
+        ValueError: For an unknown backend name
+    """
+    if option is True:
+        option = "html5lib"
+    if not option or option == "none":
+        return None
+    try:
+        return NORMALIZERS[option]
+    except KeyError:
+        raise ValueError(
+            "normalize must be one of {}, none, true or false, not {!r}".format(
+                ", ".join(NORMALIZERS), option
+            )
+        ) from None
+
+
+def normalize_html(html: str, backend: Union[bool, str] = "html5lib") -> str:
+    normalize = normalizer(backend)
+    return normalize(html) if normalize else html
+
+
+def process_html(html: str, processors: Iterable[DomProcessor]) -> str:
+    """Parse `html` once, run `processors` on the tree and serialize it.
+
+    If a processor has the `normalize` option on, the HTML is passed
+    through the normalizer of the first such processor before parsing and
+    after serialization.
+    """
+    processors = list(processors)
+    if not processors or not html.strip():
+        return html
+    normalize = next(
+        filter(None, (normalizer(p.config.get("normalize")) for p in processors)),
+        None,
+    )
+    if normalize:
+        html = normalize(html)
+    tree = lxml.html.fromstring(html)
+    for processor in processors:
+        processor.run_tree(tree)
+    html = n(et.tostring(tree, pretty_print=False))
+    if normalize:
+        html = normalize(html)
+    return str(html)
+
+
+class DomStage(Postprocessor):
+    """Run all registered `DomProcessor`s on one parse of the final HTML."""
+
+    def __init__(self, md: Markdown) -> None:
+        super().__init__(md)
+        self.processors = Registry()
+
+    def run(self, html: str) -> str:
+        return process_html(html, [p for p in self.processors if p.may_match(html)])
+
+
+def get_dom_stage(md: Markdown) -> DomStage:
+    """Return the DOM stage of `md`, registering it on first use."""
+    if STAGE_NAME in md.postprocessors:
+        return md.postprocessors[STAGE_NAME]
+    stage = DomStage(md)
+    md.postprocessors.register(stage, STAGE_NAME, STAGE_PRIORITY)
+    return stage
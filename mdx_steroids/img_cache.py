@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/img_cache.py
+"""Dimension cache used by the `mdx_steroids.img_smart` extension.
+
+The cache maps an image path or URL to a small record such as
+`{"media": "img", "width": 640, "height": 480}`. Entries for local files
+also carry the `mtime_ns` and `size` of the file they were probed from,
+and optionally a content `hash`, so a changed file is detected with a
+single `os.stat()` and re-probed on its own. Entries with an `expires`
+timestamp, used for remote images that could not be measured, are
+ignored once it has passed. It is loaded from disk
+once per process and shared by every `Markdown` instance that points at
+the same cache file. New entries are kept in memory and written back in
+one go, either at the end of a conversion or after a configurable
+interval, and always when the process exits, including the worker
+processes of a `ProcessPoolExecutor`, which skip `atexit` handlers.
+
+Writes go through a temporary file and an atomic `os.replace()`. Before
+writing, the current file contents are re-read and merged with the
+pending entries, so several build workers sharing one cache path add to
+each other's results instead of overwriting them.
+
+A cache path ending in `.sqlite`, `.sqlite3` or `.db` selects an SQLite
+store instead. It runs in WAL mode, looks entries up by primary key and
+inserts the pending entries in one transaction per flush, so parallel
+workers on one machine read and write it concurrently without ever
+rewriting the whole store. Each thread and each forked process opens
+its own connection, as SQLite requires.
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import atexit
+import hashlib
+import json
+import multiprocessing.util
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+Entry = Dict[str, Any]
+
+
+class DimensionCache:
+    """In-memory view of a JSON dimension cache file.
+
+    Args:
+        path: Location of the JSON cache file
+        flush_interval: Minimum number of seconds between two writes
+            triggered by `maybe_flush()`. With 0, every call that has
+            pending entries writes them.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0) -> None:
+        self.path = os.path.abspath(path)
+        self.flush_interval = flush_interval
+        self._entries: Dict[str, Entry] = {}
+        self._pending: Dict[str, Entry] = {}
+        self._lock = threading.RLock()
+        self._last_flush = time.monotonic()
+        self._entries = self._read()
+
+    def _after_fork(self) -> None:
+        # the parent writes its own pending entries, and may have held the lock
+        self._lock = threading.RLock()
+        self._pending.clear()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Entry]:
+        """Return the cached entry for `key`, or None."""
+        return self._entries.get(key)
+
+    def lookup(
+        self, key: str, signature: Optional[Entry] = None, use_hash: bool = False
+    ) -> Optional[Entry]:
+        """Return the entry for `key` if it still describes the file.
+
+        Args:
+            key: Cache key (local path or URL)
+            signature: Result of `file_signature()` for local files, or
+                None to accept the stored entry unless it has expired
+            use_hash: If the stat data differ but the size matches, compare
+                the stored content hash before declaring the entry stale
+
+        Returns:
+            The valid entry, or None if missing or stale
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if "expires" in entry and entry["expires"] < time.time():
+            return None
+        if signature is None:
+            return entry
+        if (
+            entry.get("mtime_ns") == signature["mtime_ns"]
+            and entry.get("size") == signature["size"]
+        ):
+            return entry
+        if (
+            use_hash
+            and entry.get("hash")
+            and entry.get("size") == signature["size"]
+            and content_hash(key) == entry["hash"]
+        ):
+            entry = dict(entry, **signature)
+            self.set(key, entry)
+            return entry
+        return None
+
+    def set(self, key: str, entry: Entry) -> None:
+        """Record `entry` for `key` in memory; it is written on the next flush."""
+        with self._lock:
+            self._entries[key] = entry
+            self._pending[key] = entry
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def maybe_flush(self) -> bool:
+        """Flush if there are pending entries and the interval has elapsed."""
+        if not self._pending:
+            return False
+        if time.monotonic() - self._last_flush < self.flush_interval:
+            return False
+        return self.flush()
+
+    def flush(self) -> bool:
+        """Merge pending entries into the cache file with an atomic rename.
+
+        Returns:
+            True if the file was written
+        """
+        with self._lock:
+            if not self._pending:
+                return False
+            with self._file_lock():
+                merged = self._read()
+                merged.update(self._pending)
+                self._write(merged)
+            self._entries.update(merged)
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+            return True
+
+    def _read(self) -> Dict[str, Entry]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data: Dict[str, Entry]) -> None:
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=".{}.".format(os.path.basename(self.path)), dir=folder
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Serialize read-merge-write cycles of processes sharing the path."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class SQLiteDimensionCache(DimensionCache):
+    """Dimension cache stored in an SQLite database in WAL mode.
+
+    Entries are read on demand and kept in memory once seen; pending
+    entries are inserted in a single transaction by `flush()`.
+
+    Args:
+        path: Location of the SQLite database, created if missing
+        flush_interval: As for `DimensionCache`
+        timeout: Seconds to wait for a lock held by another writer
+    """
+
+    SCHEMA = "CREATE TABLE IF NOT EXISTS dimensions (key TEXT PRIMARY KEY, entry TEXT)"
+
+    def __init__(
+        self, path: str, flush_interval: float = 0, timeout: float = 30
+    ) -> None:
+        self.timeout = timeout
+        self._local = threading.local()
+        super().__init__(path, flush_interval)
+        with self.connection:
+            self.connection.execute(self.SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return local_connection(self._local, self._connect)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM dimensions").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            row = self.connection.execute(
+                "SELECT entry FROM dimensions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = self._entries[key] = json.loads(row[0])
+        return entry
+
+    def flush(self) -> bool:
+        """Insert the pending entries in one transaction."""
+        with self._lock:
+            if not self._pending:
+                return False
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO dimensions VALUES (?, ?)",
+                    ((key, json.dumps(e)) for key, e in self._pending.items()),
+                )
+            self._pending.clear()
+            self._last_flush = time.monotonic()
+            return True
+
+    def _read(self) -> Dict[str, Entry]:
+        return {}
+
+
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+
+# connections opened by a parent process; kept but never used, not even
+# closed, in a forked child
+_inherited_connections: List[sqlite3.Connection] = []
+
+
+def local_connection(
+    local: threading.local, connect: Callable[[], sqlite3.Connection]
+) -> sqlite3.Connection:
+    """Return the sqlite3 connection of this thread and process in `local`.
+
+    sqlite3 connections must cross neither threads nor `fork()`, so one is
+    opened with `connect()` per thread, and again in a forked child.
+    """
+    connection = getattr(local, "connection", None)
+    if connection is not None and local.pid != os.getpid():
+        _inherited_connections.append(connection)
+        connection = None
+    if connection is None:
+        connection = local.connection = connect()
+        local.pid = os.getpid()
+    return connection
+
+
+def file_signature(path: str) -> Optional[Entry]:
+    """Return `{"mtime_ns", "size"}` of a local file, or None if it is missing."""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return a BLAKE2b-128 hex digest of the file contents."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_caches: Dict[str, DimensionCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(path: str, flush_interval: float = 0) -> DimensionCache:
+    """Return the process-wide cache object for `path`, loading it on first use."""
+    key = os.path.abspath(path)
+    with _caches_lock:
+        _register_exit_flush()
+        cache = _caches.get(key)
+        if cache is None:
+            if key.lower().endswith(SQLITE_EXTENSIONS):
+                cache = SQLiteDimensionCache(key, flush_interval)
+            else:
+                cache = DimensionCache(key, flush_interval)
+            _caches[key] = cache
+        else:
+            cache.flush_interval = flush_interval
+        return cache
+
+
+_exit_flush_pid: Optional[int] = None
+
+
+def _register_exit_flush() -> None:
+    # Workers of multiprocessing pools end with os._exit(), which skips
+    # atexit handlers but runs multiprocessing finalizers. Forked children
+    # start with an empty finalizer registry, so register once per process.
+    global _exit_flush_pid
+    if _exit_flush_pid != os.getpid():
+        _exit_flush_pid = os.getpid()
+        multiprocessing.util.Finalize(None, flush_all, exitpriority=10)
+
+
+def flush_all() -> None:
+    """Write the pending entries of every open cache."""
+    for cache in list(_caches.values()):
+        cache.flush()
+
+
+def _after_fork_in_child() -> None:
+    global _caches_lock
+    _caches_lock = threading.Lock()
+    for cache in _caches.values():
+        cache._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+atexit.register(flush_all)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/img_fetch.py
+"""Remote image metadata fetching for the `mdx_steroids.img_smart` extension.
+
+Remote images are measured by streaming only the first few kilobytes
+with an HTTP `Range` request and passing them to `img_probe.probe()`,
+within a per-URL byte budget and with connect and read timeouts.
+`prefetch()` does this for many URLs at once through a thread pool and a
+pooled `requests.Session`, so img_smart can measure every remote image of
+a document (or of a whole batch of documents) before block processing
+starts, instead of one blocking request per image.
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .img_probe import ProbeResult, probe
+
+FETCH_BYTES = 64 * 1024
+FETCH_MAX_BYTES = 1024 * 1024
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10.0
+POOL_SIZE = 16
+CHUNK_SIZE = 16 * 1024
+PROBE_STEP = 4 * 1024
+
+Timeout = Tuple[float, float]
+
+
+class Fetched(NamedTuple):
+    """Outcome of a prefetch: the probe result, the bytes read, and why it failed."""
+
+    info: Optional[ProbeResult]
+    head: bytes
+    complete: bool
+    error: Optional[requests.RequestException] = None
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide session with a connection pool per host."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def fetch_probe(
+    url: str,
+    size: int = FETCH_BYTES,
+    max_bytes: int = FETCH_MAX_BYTES,
+    timeout: Timeout = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    session: Optional[requests.Session] = None,
+) -> Tuple[Optional[ProbeResult], bytes, bool]:
+    """Stream the leading bytes of `url` until they can be measured.
+
+    The first request asks for `size` bytes with a `Range` header. If the
+    headers are not complete by then, one follow-up request continues up
+    to `max_bytes`. The body is streamed and probed as it arrives, so the
+    download stops as soon as the dimensions are known, and never reads
+    more than `max_bytes` even from servers that ignore `Range`.
+
+    Args:
+        url: Remote image or video
+        size: Number of bytes requested first
+        max_bytes: Byte budget for the URL
+        timeout: `(connect, read)` timeouts in seconds
+        session: Session to use instead of the shared one
+
+    Returns:
+        `(result, head, complete)`: the probe result or None, the bytes
+        read, and whether they are the whole file
+
+    Raises:
+        requests.RequestException: On connection errors, timeouts and
+            HTTP error statuses
+    """
+    session = session or get_session()
+    buffer = bytearray()
+    next_probe = PROBE_STEP
+    end = min(size, max_bytes)
+    while True:
+        start = len(buffer)
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            ranged = response.status_code == 206
+            if not ranged:
+                del buffer[:]  # the server sends the whole file from the start
+                end = max_bytes
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                buffer += chunk
+                if len(buffer) >= next_probe:
+                    info = probe(bytes(buffer))
+                    if info:
+                        return info, bytes(buffer), False
+                    next_probe = len(buffer) * 2
+                if len(buffer) >= end:
+                    del buffer[end:]
+                    break
+            else:
+                # the body ended before the requested range did
+                return probe(bytes(buffer)), bytes(buffer), True
+            total = _content_length(response)
+        complete = total is not None and len(buffer) >= total
+        info = probe(bytes(buffer))
+        if info or complete or end >= max_bytes:
+            return info, bytes(buffer), complete
+        end = max_bytes
+
+
+def _content_length(response: requests.Response) -> Optional[int]:
+    """Return the full size of the remote file, if the response tells it."""
+    content_range = response.headers.get("Content-Range", "")
+    total = content_range.rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    if response.status_code == 200:
+        length = response.headers.get("Content-Length", "")
+        return int(length) if length.isdigit() else None
+    return None
+
+
+def fetch_dimensions(
+    url: str,
+    size: int = FETCH_BYTES,
+    max_bytes: int = FETCH_MAX_BYTES,
+    timeout: Timeout = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    session: Optional[requests.Session] = None,
+) -> Optional[ProbeResult]:
+    """Measure a remote image from its leading bytes, or return None."""
+    try:
+        return fetch_probe(url, size, max_bytes, timeout, session)[0]
+    except requests.RequestException:
+        return None
+
+
+def prefetch(
+    urls: Iterable[str],
+    workers: int = 8,
+    size: int = FETCH_BYTES,
+    max_bytes: int = FETCH_MAX_BYTES,
+    timeout: Timeout = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    on_fetch: Optional[Callable[[str, int, float], None]] = None,
+) -> Dict[str, Fetched]:
+    """Measure many remote images concurrently.
+
+    Args:
+        urls: URLs to measure; duplicates are fetched once
+        workers: Number of concurrent requests
+        size: Number of bytes requested first per URL
+        max_bytes: Byte budget per URL
+        timeout: `(connect, read)` timeouts in seconds
+        on_fetch: Called from the worker thread with the URL, the number
+            of bytes read and the elapsed seconds after each fetch
+
+    Returns:
+        Mapping of URL to `Fetched`: `info` is None if the URL could not
+        be measured, and `error` is set if it could not be fetched, so
+        callers neither fetch it again nor lose the bytes already read
+    """
+    pending = list(dict.fromkeys(urls))
+    if not pending:
+        return {}
+    session = get_session()
+
+    def fetch(url: str) -> Fetched:
+        started = time.perf_counter()
+        try:
+            fetched = Fetched(*fetch_probe(url, size, max_bytes, timeout, session))
+        except requests.RequestException as e:
+            fetched = Fetched(None, b"", False, e)
+        if on_fetch is not None:
+            on_fetch(url, len(fetched.head), time.perf_counter() - started)
+        return fetched
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+        return dict(zip(pending, pool.map(fetch, pending)))
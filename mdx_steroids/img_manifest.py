@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/img_manifest.py
+"""Precomputed image dimension manifests for the `mdx_steroids.img_smart` extension.
+
+A manifest maps image paths or URLs to their media kind and size, as
+produced by an asset pipeline that already knows them. When img_smart is
+given a `manifest`, it looks every image up there and never probes a file
+or a URL at build time. With `manifest_strict`, an image missing from
+the manifest raises `MissingImageError`.
+
+Three formats are read, chosen by file extension:
+
+- `.json`: `{"path": {"media": "img", "width": 640, "height": 480}, ...}`
+  or a list of records with a `path` key
+- `.csv`: a header row with `path,media,width,height`
+- `.sqlite`, `.sqlite3`, `.db`: a table `images` with the primary key
+  `path` and the columns `media`, `width`, `height`; rows are looked up by
+  key instead of being loaded
+
+JSON and CSV manifests are parsed once per process and shared by all
+`Markdown` instances.
+
+The module is also a command-line tool that builds a manifest by scanning
+a directory tree with a process pool:
+
+```bash
+python -m mdx_steroids.img_manifest site/img -o manifest.json --prefix site/img/
+```
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .img_cache import SQLITE_EXTENSIONS, local_connection
+from .img_probe import probe
+
+Entry = Dict[str, Any]
+
+FIELDS = ("media", "width", "height")
+
+
+class MissingImageError(LookupError):
+    """An image is not in the manifest and `manifest_strict` is on."""
+
+
+class Manifest:
+    """Read-only mapping of image path or URL to `{"media", "width", "height"}`."""
+
+    def get(self, key: str) -> Optional[Entry]:
+        raise NotImplementedError
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+
+class DictManifest(Manifest):
+    """Manifest held in memory, loaded from JSON or CSV."""
+
+    def __init__(self, entries: Dict[str, Entry]) -> None:
+        self.entries = entries
+
+    def get(self, key: str) -> Optional[Entry]:
+        return self.entries.get(key)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteManifest(Manifest):
+    """Manifest queried by primary key from an SQLite database."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return local_connection(self._local, self._connect)
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = "file:{}?mode=ro".format(os.path.abspath(self.path))
+        return sqlite3.connect(uri, uri=True)
+
+    def get(self, key: str) -> Optional[Entry]:
+        row = self.connection.execute(
+            "SELECT media, width, height FROM images WHERE path = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+
+def _entry(record: Dict[str, Any]) -> Entry:
+    return {
+        "media": record.get("media") or "",
+        "width": int(record.get("width") or 0),
+        "height": int(record.get("height") or 0),
+    }
+
+
+def read_json(path: str) -> Dict[str, Entry]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return {record["path"]: _entry(record) for record in data}
+    return {key: _entry(record) for key, record in data.items()}
+
+
+def read_csv(path: str) -> Dict[str, Entry]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return {record["path"]: _entry(record) for record in csv.DictReader(f)}
+
+
+_manifests: Dict[str, Tuple[float, Manifest]] = {}
+_manifests_lock = threading.Lock()
+
+
+def load_manifest(path: str) -> Manifest:
+    """Return the manifest at `path`, parsed once per process and file version."""
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    with _manifests_lock:
+        loaded = _manifests.get(path)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        if path.lower().endswith(SQLITE_EXTENSIONS):
+            manifest: Manifest = SQLiteManifest(path)
+        elif path.lower().endswith(".csv"):
+            manifest = DictManifest(read_csv(path))
+        else:
+            manifest = DictManifest(read_json(path))
+        _manifests[path] = (mtime, manifest)
+        return manifest
+
+
+def write_manifest(path: str, entries: Dict[str, Entry]) -> None:
+    """Write `entries` in the format chosen by the extension of `path`."""
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        if os.path.exists(path):
+            os.unlink(path)
+        with sqlite3.connect(path) as connection:
+            connection.execute(
+                "CREATE TABLE images "
+                "(path TEXT PRIMARY KEY, media TEXT, width INTEGER, height INTEGER)"
+            )
+            connection.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?)",
+                (
+                    (key, e["media"], e["width"], e["height"])
+                    for key, e in sorted(entries.items())
+                ),
+            )
+        connection.close()
+    elif path.lower().endswith(".csv"):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(("path",) + FIELDS)
+            for key, e in sorted(entries.items()):
+                writer.writerow((key, e["media"], e["width"], e["height"]))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(sorted(entries.items())), f, indent=1)
+
+
+def measure_file(path: str) -> Optional[Entry]:
+    """Measure a local file from its headers, or return None."""
+    try:
+        with open(path, "rb") as f:
+            info = probe(f)
+    except OSError:
+        return None
+    if info is None:
+        return None
+    return {"media": info.media, "width": info.width, "height": info.height}
+
+
+def _measure(item: Tuple[str, str]) -> Tuple[str, Optional[Entry]]:
+    key, path = item
+    return key, measure_file(path)
+
+
+def iter_files(root: str) -> Iterator[str]:
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield os.path.join(folder, name)
+
+
+def scan(
+    root: str, prefix: str = "", workers: Optional[int] = None
+) -> Tuple[Dict[str, Entry], List[str]]:
+    """Measure every file below `root` in parallel.
+
+    Args:
+        root: Directory to scan
+        prefix: String prepended to each path relative to `root` to form
+            the manifest key, e.g. the `repl_path` used by img_smart
+        workers: Number of worker processes (default: CPU count)
+
+    Returns:
+        The manifest entries, and the keys of files that could not be measured
+    """
+    items = [
+        (prefix + os.path.relpath(path, root).replace(os.sep, "/"), path)
+        for path in iter_files(root)
+    ]
+    entries: Dict[str, Entry] = {}
+    skipped: List[str] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for key, entry in pool.map(_measure, items, chunksize=64):
+            if entry is None:
+                skipped.append(key)
+            else:
+                entries[key] = entry
+    return entries, skipped
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m mdx_steroids.img_manifest",
+        description="Build an img_smart dimension manifest from a directory tree.",
+    )
+    parser.add_argument("root", help="directory to scan")
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="manifest file to write (.json, .csv, .sqlite)",
+    )
+    parser.add_argument(
+        "--prefix", default="", help="string prepended to every relative path"
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None, help="number of processes"
+    )
+    args = parser.parse_args(argv)
+
+    entries, skipped = scan(args.root, args.prefix, args.workers)
+    write_manifest(args.output, entries)
+    print(
+        f"{args.output}: {len(entries)} images, {len(skipped)} files skipped",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
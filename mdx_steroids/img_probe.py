@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# this_file: mdx_steroids/img_probe.py
+"""Header-only dimension sniffing used by the `mdx_steroids.img_smart` extension.
+
+`probe()` reads the width and height of an image or video by parsing only
+the container headers, without decoding any pixel data. It reads the
+fewest bytes it can from a seekable binary stream: a few dozen bytes for
+PNG, GIF, WebP and BMP, the marker segments up to the first SOF for JPEG,
+and the box or element headers up to the first track for AVIF/HEIF,
+MP4/MOV and WebM/Matroska. SVG is read up to its root `<svg>` tag.
+
+Supported formats:
+
+- PNG (`IHDR`)
+- JPEG (first `SOFn` marker)
+- GIF (logical screen descriptor)
+- WebP (`VP8 `, `VP8L` and `VP8X` chunks)
+- AVIF / HEIF (largest `ispe` property)
+- BMP (`BITMAPINFOHEADER` and `BITMAPCOREHEADER`)
+- MP4 / MOV / M4V (`tkhd` of the first visual track)
+- WebM / Matroska (`PixelWidth` / `PixelHeight` of the first video track)
+- SVG (`viewBox`, or `width` / `height` of the root element)
+
+For anything else `probe()` returns None and the caller falls back to a
+full decode.
+
+Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
+License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
+"""
+
+import io
+import re
+import struct
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+HEAD_SIZE = 32
+SVG_HEAD_LIMIT = 64 * 1024
+
+HEIF_BRANDS = {
+    b"avif",
+    b"avis",
+    b"heic",
+    b"heix",
+    b"heim",
+    b"heis",
+    b"hevc",
+    b"hevx",
+    b"mif1",
+    b"msf1",
+}
+ISO_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"meta", b"iprp", b"ipco"}
+
+SVG_TAG_RE = re.compile(rb"<svg\b[^>]*>", re.S)
+SVG_VIEWBOX_RE = re.compile(
+    rb"""viewBox\s*=\s*["']\s*([-+.\deE]+)[\s,]+([-+.\deE]+)"""
+    rb"""[\s,]+([-+.\deE]+)[\s,]+([-+.\deE]+)\s*["']"""
+)
+SVG_SIZE_RE = re.compile(rb"""\b(width|height)\s*=\s*["']\s*([\d.]+)(px)?\s*["']""")
+
+
+class ProbeResult(NamedTuple):
+    """Media kind (`img`, `video` or `svg`) and pixel size of a file."""
+
+    media: str
+    width: int
+    height: int
+
+
+class Reader:
+    """Bounded random-access reads from a seekable binary stream.
+
+    Args:
+        stream: A seekable binary file object
+        limit: Maximum number of bytes the probe may read in total
+    """
+
+    def __init__(self, stream: BinaryIO, limit: int = 1 << 20) -> None:
+        self.stream = stream
+        self.limit = limit
+        self.bytes_read = 0
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        size = min(size, self.limit - self.bytes_read)
+        if size <= 0 or offset < 0:
+            return b""
+        self.stream.seek(offset)
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def probe(
+    source: Union[bytes, BinaryIO], limit: int = 1 << 20
+) -> Optional[ProbeResult]:
+    """Return the media kind and size of an image or video, or None.
+
+    Args:
+        source: File contents, or a seekable binary stream positioned anywhere
+        limit: Maximum number of bytes to read from the stream
+
+    Returns:
+        A `ProbeResult`, or None if the format is not recognized or the
+        headers are truncated
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return probe_reader(Reader(source, limit))
+
+
+def probe_reader(reader: Reader) -> Optional[ProbeResult]:
+    """Like `probe()`, but reports the bytes read through `reader.bytes_read`."""
+    head = reader.read_at(0, HEAD_SIZE)
+    for match, parse in SNIFFERS:
+        if match(head):
+            try:
+                size = parse(reader, head)
+            except (struct.error, ValueError, IndexError):
+                return None
+            if size is None:
+                return None
+            media, width, height = size
+            if width <= 0 or height <= 0:
+                return None
+            return ProbeResult(media, int(width), int(height))
+    return None
+
+
+def _png(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    if head[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", head[16:24])
+    return "img", width, height
+
+
+def _gif(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    width, height = struct.unpack("<HH", head[6:10])
+    return "img", width, height
+
+
+def _bmp(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    (dib_size,) = struct.unpack("<I", head[14:18])
+    if dib_size == 12:
+        width, height = struct.unpack("<HH", head[18:22])
+    else:
+        width, height = struct.unpack("<ii", head[18:26])
+    return "img", abs(width), abs(height)
+
+
+def _webp(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    kind = head[12:16]
+    if kind == b"VP8X":
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+    elif kind == b"VP8L":
+        (bits,) = struct.unpack("<I", head[21:25])
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+    elif kind == b"VP8 ":
+        width, height = struct.unpack("<HH", head[26:30])
+        width &= 0x3FFF
+        height &= 0x3FFF
+    else:
+        return None
+    return "img", width, height
+
+
+def _jpeg(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    offset = 2
+    while True:
+        marker = reader.read_at(offset, 2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD9:  # markers without a payload
+            offset += 2
+            continue
+        if code == 0xDA:  # start of scan before any SOF
+            return None
+        segment = reader.read_at(offset + 2, 7)
+        if len(segment) < 2:
+            return None
+        (length,) = struct.unpack(">H", segment[:2])
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", segment[3:7])
+            return "img", width, height
+        offset += 2 + length
+
+
+def _iso_boxes(
+    reader: Reader, start: int, end: Optional[int]
+) -> "Iterator[Tuple[bytes, int, Optional[int]]]":
+    """Yield `(type, payload_start, payload_end)` for the boxes in a range."""
+    offset = start
+    while end is None or offset + 8 <= end:
+        header = reader.read_at(offset, 16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header[:8])
+        payload = offset + 8
+        if size == 1:
+            if len(header) < 16:
+                return
+            (size,) = struct.unpack(">Q", header[8:16])
+            payload = offset + 16
+        elif size == 0:  # box extends to the end of the file
+            yield kind, payload, end
+            return
+        if size < payload - offset:
+            return
+        yield kind, payload, offset + size
+        offset += size
+
+
+def _iso_find(
+    reader: Reader,
+    start: int,
+    end: Optional[int],
+    wanted: bytes,
+    visit: "Callable[[int], bool]",
+) -> bool:
+    """Walk nested boxes in file order, calling `visit` on each `wanted` box.
+
+    Returns:
+        True as soon as `visit` returns True
+    """
+    for kind, payload, payload_end in _iso_boxes(reader, start, end):
+        if kind == wanted:
+            if visit(payload):
+                return True
+        elif kind in ISO_CONTAINERS:
+            # `meta` is a full box: skip its version and flags
+            child_start = payload + 4 if kind == b"meta" else payload
+            if _iso_find(reader, child_start, payload_end, wanted, visit):
+                return True
+    return False
+
+
+def _iso(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    (ftyp_size,) = struct.unpack(">I", head[:4])
+    brands = reader.read_at(8, max(0, min(ftyp_size, 256) - 8))
+    if {brands[i : i + 4] for i in range(0, len(brands), 4)} & HEIF_BRANDS:
+        sizes: "List[Tuple[int, int]]" = []
+
+        def visit_ispe(payload: int) -> bool:
+            data = reader.read_at(payload, 12)
+            if len(data) == 12:
+                sizes.append(struct.unpack(">II", data[4:12]))
+            return False
+
+        _iso_find(reader, 0, None, b"ispe", visit_ispe)
+        if not sizes:
+            return None
+        width, height = max(sizes, key=lambda s: s[0] * s[1])
+        return "img", width, height
+
+    found: "List[Tuple[int, int]]" = []
+
+    def visit_tkhd(payload: int) -> bool:
+        version = reader.read_at(payload, 1)
+        if not version:
+            return True
+        offset = payload + (88 if version[0] == 1 else 76)
+        data = reader.read_at(offset, 8)
+        if len(data) < 8:
+            return True
+        width, height = struct.unpack(">II", data)
+        if width >> 16 and height >> 16:
+            found.append((width >> 16, height >> 16))
+            return True
+        return False
+
+    _iso_find(reader, 0, None, b"tkhd", visit_tkhd)
+    if not found:
+        return None
+    width, height = found[0]
+    return "video", width, height
+
+
+def _ebml_id(reader: Reader, offset: int) -> Tuple[int, int]:
+    first = reader.read_at(offset, 1)
+    if not first:
+        raise ValueError("truncated EBML element")
+    length = 1
+    while length <= 4 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 4:
+        raise ValueError("invalid EBML ID")
+    data = reader.read_at(offset, length)
+    return int.from_bytes(data, "big"), length
+
+
+def _ebml_size(reader: Reader, offset: int) -> Tuple[Optional[int], int]:
+    first = reader.read_at(offset, 1)
+    if not first:
+        raise ValueError("truncated EBML size")
+    length = 1
+    while length <= 8 and not first[0] & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML size")
+    data = reader.read_at(offset, length)
+    value = int.from_bytes(data, "big") & ((1 << (7 * length)) - 1)
+    if value == (1 << (7 * length)) - 1:
+        return None, length  # unknown size
+    return value, length
+
+
+EBML_SEGMENT = 0x18538067
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACK_ENTRY = 0xAE
+EBML_VIDEO = 0xE0
+EBML_PIXEL_WIDTH = 0xB0
+EBML_PIXEL_HEIGHT = 0xBA
+EBML_CLUSTER = 0x1F43B675
+EBML_DESCEND = {EBML_SEGMENT, EBML_TRACKS, EBML_TRACK_ENTRY, EBML_VIDEO}
+
+
+def _ebml(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    # Descend into Segment, Tracks, TrackEntry and Video, skip everything
+    # else; truncated or unknown-size data raises ValueError and ends the scan
+    offset = 0
+    size: Dict[int, int] = {}
+    while True:
+        element, id_len = _ebml_id(reader, offset)
+        length, size_len = _ebml_size(reader, offset + id_len)
+        payload = offset + id_len + size_len
+        if element in (EBML_PIXEL_WIDTH, EBML_PIXEL_HEIGHT) and length:
+            size[element] = int.from_bytes(reader.read_at(payload, length), "big")
+            if len(size) == 2:
+                return "video", size[EBML_PIXEL_WIDTH], size[EBML_PIXEL_HEIGHT]
+        if element == EBML_CLUSTER:
+            return None
+        if element in EBML_DESCEND:
+            offset = payload
+        elif length is None:
+            return None
+        else:
+            offset = payload + length
+
+
+def _svg(reader: Reader, head: bytes) -> Optional[Tuple[str, int, int]]:
+    data = reader.read_at(0, SVG_HEAD_LIMIT)
+    tag = SVG_TAG_RE.search(data)
+    if not tag:
+        return None
+    viewbox = SVG_VIEWBOX_RE.search(tag.group(0))
+    if viewbox:
+        width, height = float(viewbox.group(3)), float(viewbox.group(4))
+        return "svg", round(width), round(height)
+    sizes = {m.group(1): float(m.group(2)) for m in SVG_SIZE_RE.finditer(tag.group(0))}
+    if b"width" in sizes and b"height" in sizes:
+        return "svg", round(sizes[b"width"]), round(sizes[b"height"])
+    return None
+
+
+def _is_svg(head: bytes) -> bool:
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    return text.startswith((b"<?xml", b"<svg", b"<!--", b"<!DOCTYPE svg"))
+
+
+SNIFFERS: "List[Tuple[Callable[[bytes], bool], Callable]]" = [
+    (lambda h: h.startswith(b"\x89PNG\r\n\x1a\n"), _png),
+    (lambda h: h[:3] == b"\xff\xd8\xff", _jpeg),
+    (lambda h: h[:6] in (b"GIF87a", b"GIF89a"), _gif),
+    (lambda h: h[:4] == b"RIFF" and h[8:12] == b"WEBP", _webp),
+    (lambda h: h[4:8] == b"ftyp", _iso),
+    (lambda h: h[:2] == b"BM" and len(h) >= 26, _bmp),
+    (lambda h: h[:4] == b"\x1a\x45\xdf\xa3", _ebml),
+    (_is_svg, _svg),
+]
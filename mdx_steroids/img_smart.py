@@ -3,11 +3,14 @@
 # Based on https://github.com/glushchenko/micropress/
 
 import io
-import json
+import logging
 import re
+import threading
+import time
 import xml.etree.ElementTree as etree
 # from urlparse import urlparse
 from os.path import exists
+from typing import NamedTuple, Optional
 
 import filetype
 import imageio.v3 as iio
@@ -15,6 +18,127 @@ import requests
 from markdown import Extension
 from markdown.blockprocessors import BlockProcessor
 from markdown.extensions import attr_list
+from markdown.postprocessors import Postprocessor
+from markdown.preprocessors import Preprocessor
+
+from . import img_fetch
+from .img_cache import content_hash, file_signature, get_cache
+from .img_manifest import MissingImageError, load_manifest
+from .img_probe import Reader, probe_reader
+
+logger = logging.getLogger(__name__)
+
+
+class ImageMetrics:
+    """Counters and a probe-latency histogram for img_smart.
+
+    Attributes:
+        cache_hits: Images found in the cache or manifest
+        cache_misses: Images that had to be measured or were prefetched
+        bytes_read: Bytes read from local files and remote URLs
+        fetches: HTTP fetches, including prefetches
+        probes: Number of measured images
+        probe_seconds: Total time spent measuring images
+        latency: Probe counts per `LATENCY_BUCKETS` upper bound (seconds)
+        suppressed: Warnings not logged because of `log_limit`
+
+    The attributes are running totals; `report()` logs the change since
+    the previous report, that is, the figures of one conversion.
+    """
+
+    LATENCY_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, float("inf"))
+
+    COUNTERS = (
+        "cache_hits",
+        "cache_misses",
+        "bytes_read",
+        "fetches",
+        "probes",
+        "probe_seconds",
+        "suppressed",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_read = 0
+        self.fetches = 0
+        self.probes = 0
+        self.probe_seconds = 0.0
+        self.latency = [0] * len(self.LATENCY_BUCKETS)
+        self.suppressed = 0
+        self._reported = None
+
+    def record_probe(self, seconds, nbytes, fetched=False):
+        with self._lock:
+            self.probes += 1
+            self.probe_seconds += seconds
+            self.bytes_read += nbytes
+            self.fetches += int(fetched)
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency[i] += 1
+                    break
+
+    def as_dict(self):
+        return {
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "bytes_read": self.bytes_read,
+            "fetches": self.fetches,
+            "probes": self.probes,
+            "probe_seconds": self.probe_seconds,
+            "latency": dict(zip(self.LATENCY_BUCKETS, self.latency)),
+            "suppressed": self.suppressed,
+        }
+
+    def report(self, level=logging.DEBUG):
+        """Log the counters accumulated since the previous report."""
+        with self._lock:
+            current = {name: getattr(self, name) for name in self.COUNTERS}
+            current["latency"] = list(self.latency)
+            previous, self._reported = self._reported, current
+        if not logger.isEnabledFor(level):
+            return
+        delta = dict(current)
+        if previous is not None:
+            for name in self.COUNTERS:
+                delta[name] -= previous[name]
+            delta["latency"] = [
+                now - before
+                for now, before in zip(current["latency"], previous["latency"])
+            ]
+        suppressed = delta["suppressed"]
+        histogram = " ".join(
+            f"<={bound:g}s:{count}"
+            for bound, count in zip(self.LATENCY_BUCKETS, delta["latency"])
+            if count
+        )
+        logger.log(
+            level,
+            "img_smart conversion: %d cache hits, %d misses, %d probes in %.3fs, "
+            "%d fetches, %d bytes read%s%s",
+            delta["cache_hits"],
+            delta["cache_misses"],
+            delta["probes"],
+            delta["probe_seconds"],
+            delta["fetches"],
+            delta["bytes_read"],
+            f", latency {histogram}" if histogram else "",
+            f", {suppressed} warnings suppressed" if suppressed else "",
+        )
+
+
+class ImageBlock(NamedTuple):
+    """The parts of a one-line Markdown image block."""
+
+    alt: Optional[str]
+    url: str
+    attr: Optional[str]
 
 
 class MDXSmartImageProcessor(BlockProcessor):
@@ -51,100 +175,96 @@ class MDXSmartImageProcessor(BlockProcessor):
         r'viewBox="(\d*?) (\d*?) (\d*?) (\d*?)"'
     )  # Already uses r""
 
-    def __init__(self, md, config):
+    # {: width=400 .class } after the image
+    ATTR_RE = re.compile(r"^\{\:?([^\}]*)\}")
+    # Characters not allowed in an attribute name
+    NAME_RE = re.compile(
+        r"[^A-Z_a-z\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u02ff"
+        r"\u0370-\u037d\u037f-\u1fff\u200c-\u200d"
+        r"\u2070-\u218f\u2c00-\u2fef\u3001-\ud7ff"
+        r"\uf900-\ufdcf\ufdf0-\ufffd"
+        r"\:\-\.0-9\u00b7\u0300-\u036f\u203f-\u2040]+"
+    )
+
+    def __init__(
+        self, md, config, cache=None, prefetched=None, manifest=None, metrics=None
+    ):
         super().__init__(md)
         self.config = config
+        self.cache = cache
+        self.prefetched = {} if prefetched is None else prefetched
+        self.manifest = manifest
+        self.metrics = ImageMetrics() if metrics is None else metrics
+        self.warnings = 0
+        self.log_level = logging.DEBUG
+        self._parsed = (None, None)
+
+    def parse_block(self, block):
+        """Return the `ImageBlock` of a one-line image block, or None.
+
+        The result for the last block is kept, so `run()` reuses the
+        match made by `test()` for the same block.
+        """
+        if self._parsed[0] is block:
+            return self._parsed[1]
+        record = None
+        if len(block.splitlines()) == 1:
+            rImage = self.FIGURES_RE.search(block)
+            if rImage:
+                rLink = self.INLINE_LINK_RE.search(rImage.group(0))
+                if rLink:
+                    record = ImageBlock(rImage.group(1), rLink.group(2), rLink.group(3))
+                else:
+                    record = ImageBlock(rImage.group(1), "", None)
+        self._parsed = (block, record)
+        return record
 
     def test(self, parent, block):
-        isImage = bool(self.FIGURES_RE.search(block))
-        isOnlyOneLine = len(block.splitlines()) == 1
-        return isImage and isOnlyOneLine
+        return self.parse_block(block) is not None
 
     def run(self, parent, blocks):
-        cache_path = self.config.get("cache", "")
-        cache = {}
-        if cache_path and exists(cache_path):
-            with open(cache_path) as f:
-                cache = json.load(f)
-
-        alt = url = attr = None
-
-        raw_block = blocks.pop(0)
-        mdImage = self.FIGURES_RE.search(raw_block).group(0)
+        cache = self.cache
 
-        if rAlt := self.FIGURES_RE.search(raw_block):
-            alt = rAlt.group(1)
-
-        if rUrl := self.INLINE_LINK_RE.search(mdImage):
-            url = rUrl.group(2)
-
-        if rAttr := self.INLINE_LINK_RE.search(mdImage):
-            attr = self.INLINE_LINK_RE.search(mdImage).group(3)
+        alt, url, attr = self.parse_block(blocks.pop(0))
 
         url_find = self.config.get("find", None)
-        url_repl_path = self.config.get("repl_path", None)
         url_repl_url = self.config.get("repl_url", None)
         alt_figure = self.config.get("alt_figure", False)
 
         if not url:
             url = ""
-        filepath = url
+        filepath = self.image_filepath(url)
         orig_url = url
-        if url_find and url_repl_path:
-            filepath = filepath.replace(url_find, url_repl_path)
         if url_find and url_repl_url:
             url = url.replace(url_find, url_repl_url)
 
         width = height = 0
 
-        if filepath in cache.keys():
-            media = cache[filepath]["media"]
-            width = cache[filepath]["width"]
-            height = cache[filepath]["height"]
+        entry = signature = None
+        if self.manifest is not None:
+            entry = self.manifest.get(filepath) or self.manifest.get(orig_url)
+            if entry is None and self.config.get("manifest_strict", False):
+                raise MissingImageError(f"{filepath} is not in the image manifest")
+            entry = entry or {"media": "", "width": 0, "height": 0}
+        elif cache is not None:
+            if not filepath.startswith("http"):
+                signature = file_signature(filepath)
+            entry = cache.lookup(
+                filepath, signature, self.config.get("cache_hash", False)
+            )
+        if entry is not None:
+            self.metrics.cache_hits += 1
+            media = entry["media"]
+            width = entry["width"]
+            height = entry["height"]
+        elif filepath in self.prefetched:
+            self.metrics.cache_misses += 1
+            media, width, height = self.prefetched_dimensions(
+                filepath, self.prefetched[filepath]
+            )
         else:
-            width = height = 0
-            imbytes = imbytesio = immeta = None
-            if filepath.startswith("http"):
-                try:
-                    response = requests.get(filepath)
-                    imbytesio = io.BytesIO(response.content)
-                except Exception:  # E722 Specify exception
-                    pass
-            elif exists(filepath):
-                imbytesio = open(filepath, "rb")
-            if imbytesio:
-                imbytes = imbytesio.read()
-                print(f"Analyzing image: {filepath} with size {len(imbytes)}")
-                media = ""
-                if b"</svg>" in imbytes and b"<svg" in imbytes:
-                    svg = str(imbytes)
-                    media = "svg"
-                    rem = self.SVG_VIEWBOX_RE.search(svg)
-                    if rem:
-                        width = int(rem.group(3)) - int(rem.group(1))
-                        height = int(rem.group(4)) - int(rem.group(2))
-                elif b"</html>" in imbytes and b"<html" in imbytes:
-                    media = "html"
-                    print(f"WARNING: {filepath} is of type HTML, possibly 404")
-                else:
-                    guess = filetype.guess_mime(imbytes)
-                    if guess:
-                        media = guess.split("/")[0].replace("image", "img")
-                try:
-                    imbytesio.seek(0)
-                    if media in ("video"):
-                        frames = iio.imread(imbytesio, plugin="pyav", index=None)
-                        if frames.any():
-                            width = frames.shape[1]
-                            height = frames.shape[2]
-                    elif media in ("img"):
-                        immeta = iio.immeta(imbytesio)
-                        if immeta:
-                            width, height = immeta.get("shape", (None, None))
-                except:
-                    print(f"{filepath} is not a valid video, image or SVG")
-                if imbytesio:  # Check if imbytesio was successfully opened
-                    imbytesio.close()
+            self.metrics.cache_misses += 1
+            media, width, height = self.probe_dimensions(filepath)
 
         if width > 1920:
             height = int(height * 1920 / width)
@@ -152,11 +272,20 @@ class MDXSmartImageProcessor(BlockProcessor):
         if height > 1080:
             width = int(width * 1080 / height)
             height = 1080
-        if width:
-            cache[filepath] = {"media": media, "width": width, "height": height}
-        if cache_path:
-            with open(cache_path, "w") as f:
-                json.dump(cache, f)
+        if width and cache is not None and entry is None:
+            entry = {"media": media, "width": width, "height": height}
+            if signature:
+                entry.update(signature)
+                if self.config.get("cache_hash", False):
+                    entry["hash"] = content_hash(filepath)
+            cache.set(filepath, entry)
+        elif not width and cache is not None and entry is None:
+            ttl = float(self.config.get("fetch_failure_ttl", 0))
+            if ttl and filepath.startswith("http"):
+                cache.set(
+                    filepath,
+                    {"media": "", "width": 0, "height": 0, "expires": time.time() + ttl},
+                )
 
         scale = 2.0
         title = None
@@ -223,21 +352,175 @@ class MDXSmartImageProcessor(BlockProcessor):
             insel = figure
         parent.append(insel)
 
+    def image_filepath(self, url):
+        """Return the local path or URL from which the image is measured."""
+        url_find = self.config.get("find", None)
+        url_repl_path = self.config.get("repl_path", None)
+        if url_find and url_repl_path:
+            return url.replace(url_find, url_repl_path)
+        return url
+
+    def remote_filepaths(self, text):
+        """Return the remote image URLs in `text` that are not cached yet."""
+        paths = []
+        for line in text.splitlines():
+            image = self.parse_block(line)
+            if not image or not image.url:
+                continue
+            filepath = self.image_filepath(image.url)
+            if not filepath.startswith("http") or filepath in self.prefetched:
+                continue
+            if self.cache is not None and self.cache.lookup(filepath) is not None:
+                continue
+            paths.append(filepath)
+        return paths
+
+    def prefetch(self, texts):
+        """Measure the remote images of several documents concurrently."""
+        urls = [path for text in texts for path in self.remote_filepaths(text)]
+        self.prefetched.update(
+            img_fetch.prefetch(
+                urls,
+                workers=int(self.config.get("prefetch_workers", 8)),
+                on_fetch=lambda url, nbytes, seconds: self.metrics.record_probe(
+                    seconds, nbytes, fetched=True
+                ),
+                **self.fetch_options(),
+            )
+        )
+
+    def fetch_options(self):
+        """Return the byte budget and timeouts for remote images."""
+        return {
+            "size": int(self.config.get("fetch_bytes", img_fetch.FETCH_BYTES)),
+            "max_bytes": int(
+                self.config.get("fetch_max_bytes", img_fetch.FETCH_MAX_BYTES)
+            ),
+            "timeout": (
+                float(
+                    self.config.get(
+                        "fetch_connect_timeout", img_fetch.CONNECT_TIMEOUT
+                    )
+                ),
+                float(self.config.get("fetch_read_timeout", img_fetch.READ_TIMEOUT)),
+            ),
+        }
+
+    def warn(self, msg, *args):
+        """Log a warning, at most `log_limit` times per conversion."""
+        self.warnings += 1
+        if self.warnings > int(self.config.get("log_limit", 10)):
+            self.metrics.suppressed += 1
+            return
+        logger.warning(msg, *args)
+
+    def prefetched_dimensions(self, filepath, fetched):
+        """Return (media, width, height) from an `img_fetch.Fetched` outcome.
+
+        Failed fetches are not retried; they get the `fetch_failure_ttl`
+        entry like any unmeasurable URL. Complete files that `img_probe`
+        does not know are passed to imageio from the bytes already read.
+        """
+        if fetched.error is not None:
+            self.warn("%s could not be fetched: %s", filepath, fetched.error)
+            return "", 0, 0
+        if fetched.info:
+            return fetched.info
+        if not fetched.complete:
+            return "", 0, 0
+        return self._probe_stream(filepath, io.BytesIO(fetched.head), [0])
+
+    def probe_dimensions(self, filepath):
+        """Return (media, width, height) of a local file or URL, with metrics."""
+        started = time.perf_counter()
+        nbytes = [0]
+        try:
+            return self._probe_dimensions(filepath, nbytes)
+        finally:
+            self.metrics.record_probe(
+                time.perf_counter() - started,
+                nbytes[0],
+                fetched=filepath.startswith("http"),
+            )
+
+    def _probe_dimensions(self, filepath, nbytes):
+        """Return (media, width, height) of a local file or URL.
+
+        Known formats are measured from their headers only; anything else
+        is read in full and passed to imageio. Remote files are streamed
+        within the `fetch_max_bytes` budget and only passed to imageio if
+        they fit in it. The number of bytes read is added to `nbytes[0]`.
+        """
+        imbytesio = None
+        if filepath.startswith("http"):
+            try:
+                info, head, complete = img_fetch.fetch_probe(
+                    filepath, **self.fetch_options()
+                )
+            except requests.RequestException as e:
+                self.warn("%s could not be fetched: %s", filepath, e)
+                return "", 0, 0
+            nbytes[0] += len(head)
+            if info:
+                return info
+            if complete:
+                imbytesio = io.BytesIO(head)
+        elif exists(filepath):
+            imbytesio = open(filepath, "rb")
+        if not imbytesio:
+            return "", 0, 0
+        return self._probe_stream(filepath, imbytesio, nbytes)
+
+    def _probe_stream(self, filepath, imbytesio, nbytes):
+        """Return (media, width, height) of an open file, closing it."""
+        media = ""
+        width = height = 0
+        with imbytesio:
+            reader = Reader(imbytesio)
+            info = probe_reader(reader)
+            if not filepath.startswith("http"):
+                nbytes[0] += reader.bytes_read
+            if info:
+                return info
+            imbytesio.seek(0)
+            imbytes = imbytesio.read()
+            if not filepath.startswith("http"):
+                nbytes[0] += len(imbytes)
+            logger.debug("Analyzing image: %s with size %d", filepath, len(imbytes))
+            if b"</svg>" in imbytes and b"<svg" in imbytes:
+                svg = str(imbytes)
+                media = "svg"
+                rem = self.SVG_VIEWBOX_RE.search(svg)
+                if rem:
+                    width = int(rem.group(3)) - int(rem.group(1))
+                    height = int(rem.group(4)) - int(rem.group(2))
+            elif b"</html>" in imbytes and b"<html" in imbytes:
+                media = "html"
+                self.warn("%s is of type HTML, possibly 404", filepath)
+            else:
+                guess = filetype.guess_mime(imbytes)
+                if guess:
+                    media = guess.split("/")[0].replace("image", "img")
+            try:
+                imbytesio.seek(0)
+                if media in ("video"):
+                    frames = iio.imread(imbytesio, plugin="pyav", index=None)
+                    if frames.any():
+                        width = frames.shape[2]
+                        height = frames.shape[1]
+                elif media in ("img"):
+                    immeta = iio.immeta(imbytesio)
+                    if immeta:
+                        width, height = immeta.get("shape", (None, None))
+            except Exception:
+                self.warn("%s is not a valid video, image or SVG", filepath)
+        return media, width, height
+
     # ![By default](/i/ukrainian-keyboard-default.png){: width=400} assign width i.e. <img width="400"/>
     def assignExtra(self, img, attr):
         image_size = {}
 
-        BASE_RE = r"\{\:?([^\}]*)\}"  # Already raw
-        INLINE_RE = re.compile(r"^%s" % BASE_RE)  # Uses BASE_RE which is raw
-        NAME_RE = re.compile(  # Made raw
-            r"[^A-Z_a-z\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u02ff"
-            r"\u0370-\u037d\u037f-\u1fff\u200c-\u200d"
-            r"\u2070-\u218f\u2c00-\u2fef\u3001-\ud7ff"
-            r"\uf900-\ufdcf\ufdf0-\ufffd"
-            r"\:\-\.0-9\u00b7\u0300-\u036f\u203f-\u2040]+"
-        )
-
-        m = INLINE_RE.match(attr)
+        m = self.ATTR_RE.match(attr)
         if m:
             attr = m.group(1)
 
@@ -257,7 +540,7 @@ class MDXSmartImageProcessor(BlockProcessor):
                         except ValueError:
                             pass
                     else:
-                        key = NAME_RE.sub("_", k)
+                        key = self.NAME_RE.sub("_", k)
                         img.set(key, v)
 
                     if k == "width":
@@ -269,6 +552,44 @@ class MDXSmartImageProcessor(BlockProcessor):
         return image_size
 
 
+class MDXSmartImagePrefetcher(Preprocessor):
+    """Measure all remote images of the document before block parsing."""
+
+    def __init__(self, md, processor):
+        super().__init__(md)
+        self.processor = processor
+
+    def run(self, lines):
+        self.processor.prefetch(["\n".join(lines)])
+        return lines
+
+
+class MDXSmartImageFinisher(Postprocessor):
+    """Write new cache entries and report metrics once the conversion is finished."""
+
+    def __init__(self, md, processor):
+        super().__init__(md)
+        self.processor = processor
+
+    def run(self, text):
+        processor = self.processor
+        if processor.cache is not None:
+            processor.cache.maybe_flush()
+        processor.metrics.report(processor.log_level)
+        processor.warnings = 0
+        return text
+
+
+def resolve_log_level(level):
+    """Return the numeric logging level for an int or a level name like "info"."""
+    if isinstance(level, int) and not isinstance(level, bool):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError(f"img_smart: unknown log_level {level!r}")
+    return number
+
+
 class MDXSmartImageExtension(Extension):
     def __init__(self, *args, **kwargs):
         self.config = {
@@ -276,18 +597,97 @@ class MDXSmartImageExtension(Extension):
             "repl_path": ["", "the string to replace for the local path"],
             "repl_url": ["", "the string to replace for the final URL"],
             "alt_figure": [False, "Build <figure> from ![alt]() text"],
-            "cache": ["", "cache JSON file to speed up processing"],
+            "cache": [
+                "",
+                "cache JSON file (or .sqlite/.db SQLite store) to speed up processing",
+            ],
+            "cache_flush_interval": [
+                0,
+                "Minimum seconds between cache writes; 0 writes after each conversion",
+            ],
+            "cache_hash": [
+                False,
+                "Store a content hash so touched but unchanged files are not re-probed",
+            ],
             "lazy": [False, 'Add loading="lazy" attribute to images'],
+            "prefetch": [
+                False,
+                "Measure all remote images of a document concurrently before parsing",
+            ],
+            "prefetch_workers": [8, "Number of concurrent prefetch requests"],
+            "fetch_bytes": [
+                img_fetch.FETCH_BYTES,
+                "Number of leading bytes requested first to measure a remote image",
+            ],
+            "fetch_max_bytes": [
+                img_fetch.FETCH_MAX_BYTES,
+                "Maximum number of bytes downloaded to measure a remote image",
+            ],
+            "fetch_connect_timeout": [
+                img_fetch.CONNECT_TIMEOUT,
+                "Connect timeout in seconds for remote images",
+            ],
+            "fetch_read_timeout": [
+                img_fetch.READ_TIMEOUT,
+                "Read timeout in seconds for remote images",
+            ],
+            "fetch_failure_ttl": [
+                86400,
+                "Seconds a remote image that could not be measured stays cached",
+            ],
+            "manifest": [
+                "",
+                "JSON, CSV or SQLite manifest of image sizes; disables probing",
+            ],
+            "manifest_strict": [
+                False,
+                "Raise MissingImageError for images missing from the manifest",
+            ],
+            "log_level": [
+                "DEBUG",
+                "Logging level (name or number) of the per-conversion metrics summary",
+            ],
+            "log_limit": [10, "Maximum number of warnings logged per conversion"],
         }
+        self.prefetched = {}
+        self.processor = None
+        self.metrics = ImageMetrics()
         super().__init__(*args, **kwargs)
 
     def extendMarkdown(self, md):
-        self.getConfigs()
-        smartImage = MDXSmartImageProcessor(md.parser, self.getConfigs())
+        config = self.getConfigs()
+        log_level = resolve_log_level(config.get("log_level", "DEBUG"))
+        cache = manifest = None
+        if config.get("manifest"):
+            manifest = load_manifest(config["manifest"])
+        elif config.get("cache"):
+            cache = get_cache(
+                config["cache"], float(config.get("cache_flush_interval", 0))
+            )
+        smartImage = MDXSmartImageProcessor(
+            md.parser, config, cache, self.prefetched, manifest, self.metrics
+        )
+        smartImage.log_level = log_level
+        self.processor = smartImage
+        md.postprocessors.register(
+            MDXSmartImageFinisher(md, smartImage), "smartImageFinish", 0
+        )
         # Modern way to add blockprocessors
         md.parser.blockprocessors.register(
             smartImage, "smartImage", 75
         )  # Priority 75, adjust as needed (e.g. <ulist is often around 70-80)
+        if config.get("prefetch", False) and manifest is None:
+            md.preprocessors.register(
+                MDXSmartImagePrefetcher(md, smartImage), "smartImagePrefetch", 5
+            )
+
+    def prefetch_documents(self, texts):
+        """Measure the remote images of a batch of Markdown documents.
+
+        Call this after the extension has been added to a `Markdown`
+        instance; later conversions then find the results in memory.
+        """
+        self.processor.prefetch(texts)
 
 
 def makeExtension(*args, **kwargs):
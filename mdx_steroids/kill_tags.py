@@ -22,12 +22,40 @@ Elements matching to these selectors will be completely removed from the final H
 * The `kill_known` option allows to remove (if true) or keep (if false) certain hardcoded selectors.
 
 * The `kill_empty` option allows to specify a list of simple element tags which will be removed if they’re empty.
-
-* The `normalize` option will pass the final HTML through BeautifulSoup if true.
+An element is empty if neither it nor its descendants have any attribute or non-whitespace text.
+
+* The `kill_empty_cascade` option, if true, also removes any element (such as an `li` or a `blockquote`)
+that is empty once all its children were removed as empty.
+
+* The `normalize` option passes the HTML through a normalizing parser before and after processing:
+`html5lib` (BeautifulSoup with html5lib, also selected by `true`), `lxml` (much faster), `html5-parser`
+(fast and spec-compliant, needs `pip install html5-parser`) or `none` (the default, also selected by `false`).
+
+* The `stream` option, if true, removes elements while the HTML is parsed incrementally, for very large
+documents. Matching and empty elements are dropped as soon as they are closed, and each top-level
+element is written out and freed as soon as the next one is complete, so memory is bounded by the
+largest top-level block rather than by the document. It needs every `kill` selector to be a CSS
+selector made of type, class, id and attribute selectors, optionally joined by descendant or child
+combinators, and `kill_known` and `normalize` to be off; otherwise the regular mode is used. Unlike the
+regular mode, the output is never wrapped in a `<div>`.
+
+* The `mode` option set to `tree` removes matching and empty elements from the Python-Markdown tree,
+before it is serialized, so no HTML is parsed. This covers the same selectors as `stream`. If some
+`kill` selectors are not of this kind, if `kill_known` is on, or if raw HTML in the document may
+contain matching or empty elements, the final HTML is also processed as in the default
+`postprocessor` mode. Note that fenced code blocks are stored as raw HTML by Python-Markdown, and
+that in the tree, elements that only hold inline raw HTML are not empty.
+
+The HTML is parsed once per conversion by the DOM stage shared with
+`mdx_steroids.translate_no` (see `mdx_steroids.dom`), so using both
+extensions costs a single parse and serialization. Selectors are compiled
+once per process and shared by all `Markdown` instances. Documents in which
+a quick text search finds none of the targeted tags, classes or empty
+elements are returned unchanged, without being parsed.
 
 ```yaml
   mdx_steroids.kill_tags:
-    normalize: false  # Do not use BeautifulSoup for post-processing
+    normalize: none   # Or html5lib, lxml, html5-parser
     kill:             # List of CSS selectors or (with "!" prefix) XPath selectors to delete
       - "!//pre[@class and contains(concat(' ', normalize-space(@class), ' '), ' highlight ') and code[@class and
       contains(concat(' ', normalize-space(@class), ' '), ' language-del ')]]"
@@ -36,6 +64,9 @@ Elements matching to these selectors will be completely removed from the final H
     kill_empty:       # List of HTML tags (simple) to be removed if they’re empty
       - p
       - div
+    kill_empty_cascade: false # Do not remove other elements left empty
+    stream: false     # Do not parse incrementally
+    mode: postprocessor # Or tree
 ```
 
 ### Example
@@ -135,20 +166,76 @@ Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
 License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
 """
 
-from future.utils import bytes_to_native_str as n
-
 __version__ = "0.5.4"
 
-import lxml.cssselect as cssselect
+import html as htmllib
+import logging
+
 import lxml.etree as et
-import lxml.html
-import lxml.html.soupparser
-from bs4 import BeautifulSoup
+from future.utils import bytes_to_native_str as n
 from markdown import Extension
-from markdown.postprocessors import Postprocessor
+from markdown.treeprocessors import Treeprocessor
+
+from .dom import (
+    STAGE_PRIORITY,
+    DomProcessor,
+    SelectorMatcher,
+    compile_prefilter,
+    compile_union,
+    get_dom_stage,
+    normalizer,
+    parse_simple,
+    selector_to_xpath,
+)
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+TOP_LEVEL = ("head", "body")
+# the characters removed by XPath normalize-space(), unlike str.strip()
+XML_SPACE = " \t\r\n"
+
+
+def find_empty(root, tags, cascade=False):
+    """Return the elements below `root` to remove as empty, in document order.
+
+    An element of `tags` is empty if neither it nor any descendant has an
+    attribute or text other than XML whitespace (its own tail aside), so a
+    `<p>&nbsp;</p>` spacer is kept. One bottom-up pass over the tree
+    decides this for every element, so the cost is linear in document
+    size. With `cascade`, an element whose children
+    are all removed and that is empty itself is removed too, whatever its
+    tag. Works on lxml and `xml.etree` trees.
+    """
+    elements = list(root.iter())
+    has_content = {}
+    removed = {}
+    # reversed document order visits every element after its descendants
+    for el in reversed(elements):
+        if not isinstance(el.tag, str):  # comment or processing instruction
+            continue
+        content = bool(el.attrib) or bool(el.text and el.text.strip(XML_SPACE))
+        children = 0
+        all_removed = True
+        for child in el:
+            if child.tail and child.tail.strip(XML_SPACE):
+                content = True
+            if isinstance(child.tag, str):
+                children += 1
+                content = content or has_content[child]
+                all_removed = all_removed and removed[child]
+        has_content[el] = content
+        removed[el] = not content and (
+            el.tag in tags or (cascade and children > 0 and all_removed)
+        )
+    return [el for el in elements if removed.get(el) and el is not root]
+
+
+class KillTagsPostprocessor(DomProcessor):
+    compiled = False
+    kill = None
+    kill_empty = None
 
-
-class KillTagsPostprocessor(Postprocessor):
     def remove_keeping_tail(self, element):
         """Safe the tail text and then delete the element"""
         self._preserve_tail_before_delete(element)
@@ -171,9 +258,15 @@ class KillTagsPostprocessor(Postprocessor):
                 else:
                     parent.text = parent.text + node.tail
 
-    def normalize_html(self):
-        out = BeautifulSoup(self.html, "html5lib")
-        self.html = str(out)
+    def remove_all(self, tree, elements):
+        """Remove `elements`, given in document order, keeping their tails.
+
+        Elements inside an already removed element are skipped.
+        """
+        root = tree.getroottree().getroot()
+        for el in elements:
+            if el.getparent() is not None and el.getroottree().getroot() is root:
+                self.remove_keeping_tail(el)
 
     def known_selectors(self):
         return [
@@ -182,62 +275,265 @@ class KillTagsPostprocessor(Postprocessor):
             "descendant-or-self::del",
         ]
 
+    def known_hints(self):
+        """CSS selectors that `known_selectors()` need to match, for the prefilter."""
+        return ["code.language-del", "del"]
+
     def parse_selector(self, selector):
-        cx = cssselect.LxmlHTMLTranslator()
-        if selector[:1] == "!":  # direct XPath selector
-            xpath_sel = selector[1:]
-        else:
-            xpath_sel = cx.css_to_xpath(selector)  # CSS selector
-        return xpath_sel
+        return selector_to_xpath(selector)
 
-    def kill_selectors(self):
-        tree = lxml.html.fromstring(self.html)
-        for kill_selector in self.kill:
-            for el in tree.xpath(kill_selector):
+    def empty_elements(self, tree):
+        """Return the elements to remove as empty, in document order."""
+        return find_empty(
+            tree, self.kill_empty, self.config.get("kill_empty_cascade", False)
+        )
+
+    def compile_selectors(self):
+        """Merge the configured `kill` selectors into one compiled XPath.
+
+        The union is a single query whatever the number of selectors.
+        """
+        kill = list(self.config.get("kill", []))
+        hints = list(kill)
+        if self.config.get("kill_known", False):
+            kill += ["!" + sel for sel in self.known_selectors()]
+            hints += self.known_hints()
+        self.kill = compile_union(tuple(kill))
+        self.kill_empty = frozenset(self.config.get("kill_empty", []))
+        self.prefilter = compile_prefilter(tuple(hints), tuple(sorted(self.kill_empty)))
+        self.compiled = True
+
+    def kill_selectors(self, tree):
+        if self.kill is not None:
+            self.remove_all(tree, self.kill(tree))
+        if self.kill_empty:
+            self.remove_all(tree, self.empty_elements(tree))
+
+    def run_tree(self, tree):
+        if not self.compiled:
+            self.compile_selectors()
+        self.kill_selectors(tree)
+
+
+class KillTagsStreamPostprocessor(KillTagsPostprocessor):
+    """Remove elements while the HTML is parsed incrementally.
+
+    Elements are tested when their end tag is parsed: their descendants are
+    complete and processed by then, and their ancestors are still in the
+    tree. Top-level elements that are complete, tail included, are
+    serialized and removed from the tree.
+
+    Args:
+        md: The Markdown instance
+        config: The extension configuration
+        selectors: The parsed `kill` selectors
+    """
+
+    def __init__(self, md, config, selectors):
+        super().__init__(md)
+        self.config = config
+        self.matcher = SelectorMatcher(selectors)
+        self.kill_empty = frozenset(config.get("kill_empty", []))
+        self.cascade = config.get("kill_empty_cascade", False)
+        self.prefilter = compile_prefilter(
+            tuple(config.get("kill", [])), tuple(sorted(self.kill_empty))
+        )
+        self.compiled = True
+
+    def is_empty(self, el):
+        """Record whether `el` has content, and tell if it is to be removed as empty.
+
+        Uses the content flags recorded for its children, which are complete
+        and processed by the time `el` is closed.
+        """
+        content = bool(el.attrib) or bool(el.text and el.text.strip(XML_SPACE))
+        has_children = False
+        for child in el:
+            if child.tail and child.tail.strip(XML_SPACE):
+                content = True
+            if isinstance(child.tag, str):
+                has_children = True
+                content = self.content.pop(child, True) or content
+        all_removed = self.removed.pop(el, 0) > 0 and not has_children
+        self.content[el] = content
+        return not content and (
+            el.tag in self.kill_empty or (self.cascade and all_removed)
+        )
+
+    def flush(self, parent, upto=None):
+        """Write out and drop the children of `parent` before `upto`."""
+        if parent.text:
+            text = htmllib.escape(parent.text, quote=False)
+            self.out.append(text.encode("ascii", "xmlcharrefreplace").decode("ascii"))
+            parent.text = None
+        for child in list(parent):
+            if child is upto:
+                break
+            self.out.append(n(et.tostring(child)))
+            self.content.pop(child, None)
+            parent.remove(child)
+
+    def consume(self, events):
+        for _, el in events:
+            parent = el.getparent()
+            if parent is None or el.tag in TOP_LEVEL:
+                continue
+            empty = self.is_empty(el)
+            if self.matcher.matches(el, lambda: list(el.iterancestors())):
+                # as in the DOM modes, killed elements do not count for
+                # kill_empty_cascade: they are gone before emptiness is tested
+                del self.content[el]
                 self.remove_keeping_tail(el)
-        for kill_empty_selector in self.kill_empty:
-            for el in tree.xpath(
-                "//{}["
-                "not(descendant-or-self::*/text()[normalize-space()])"
-                " and not(descendant-or-self::*/attribute::*)"
-                "]".format(kill_empty_selector)
-            ):
+            elif empty:
+                del self.content[el]
+                self.removed[parent] = self.removed.get(parent, 0) + 1
                 self.remove_keeping_tail(el)
-        out = n(et.tostring(tree, pretty_print=False))
-        self.html = str(out)
+            elif parent.tag in TOP_LEVEL:
+                # the elements before el are complete, tails included
+                self.flush(parent, el)
 
     def run(self, html):
-        self.html = html
-        self.kill = [self.parse_selector(sel) for sel in self.config.get("kill", [])]
-        if self.config.get("kill_known", False):
-            self.kill += self.known_selectors()
-        self.kill_empty = self.config.get("kill_empty", [])
-        if self.config.get("normalize", False):
-            self.normalize_html()
-        self.kill_selectors()
-        if self.config.get("normalize", False):
-            self.normalize_html()
-        return str(self.html)
+        if not html.strip() or not self.may_match(html):
+            return html
+        self.out = []
+        self.content = {}
+        self.removed = {}
+        parser = et.HTMLPullParser(events=("end",))
+        for start in range(0, len(html), STREAM_CHUNK_SIZE):
+            parser.feed(html[start : start + STREAM_CHUNK_SIZE])
+            self.consume(parser.read_events())
+        root = parser.close()
+        self.consume(parser.read_events())
+        for part in root:
+            if part.tag in TOP_LEVEL:
+                self.flush(part)
+        html, self.out, self.content, self.removed = "".join(self.out), [], {}, {}
+        return html
+
+
+class KillTagsTreeprocessor(Treeprocessor):
+    """Remove matching and empty elements from the Python-Markdown tree.
+
+    Args:
+        md: The Markdown instance
+        config: The extension configuration
+        selectors: The `kill` selectors that are `SimpleSelector`s
+    """
+
+    def __init__(self, md, config, selectors):
+        super().__init__(md)
+        self.matcher = SelectorMatcher(selectors)
+        self.kill_empty = frozenset(config.get("kill_empty", []))
+        self.cascade = config.get("kill_empty_cascade", False)
+
+    def remove_keeping_tail(self, parent, element):
+        """Move the tail text to the previous sibling or the parent, and remove."""
+        if element.tail:
+            index = list(parent).index(element)
+            if index:
+                previous = parent[index - 1]
+                previous.tail = (previous.tail or "") + element.tail
+            else:
+                parent.text = (parent.text or "") + element.tail
+        parent.remove(element)
+
+    def remove_all(self, root, elements):
+        """Remove `elements`, given in document order, keeping their tails.
+
+        Elements inside an already removed element are skipped.
+        """
+        parents = {child: parent for parent in root.iter() for child in parent}
+        removed = set()
+        for el in elements:
+            ancestor = parents[el]
+            while ancestor is not None and ancestor not in removed:
+                ancestor = parents.get(ancestor)
+            if ancestor is None:
+                self.remove_keeping_tail(parents[el], el)
+                removed.add(el)
+
+    def run(self, root):
+        if self.matcher.by_tag:
+            self.remove_all(root, list(self.matcher.iter_matches(root)))
+        if self.kill_empty:
+            self.remove_all(root, find_empty(root, self.kill_empty, self.cascade))
 
 
 class KillTagsExtension(Extension):
     def __init__(self, *args, **kwargs):
         self.config = {
-            "normalize": [False, "Normalize HTML before processing"],
+            "normalize": [
+                "none",
+                "Normalize HTML with html5lib, lxml, html5-parser or none",
+            ],
             "kill": [[], "List of element CSS selectors to be removed, with contents"],
             "kill_known": [False, 'Also remove some "known" selectors, with contents'],
             "kill_empty": [
                 ["p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "pre"],
                 "List of HTML tags to be removed if they are empty",
             ],
+            "kill_empty_cascade": [
+                False,
+                "Also remove elements left empty by removing all their children",
+            ],
+            "stream": [
+                False,
+                "Remove elements while parsing incrementally (simple CSS selectors only)",
+            ],
+            "mode": [
+                "postprocessor",
+                "Remove elements from the final HTML (postprocessor) or from the "
+                "Markdown tree before serialization (tree)",
+            ],
         }
         super().__init__(*args, **kwargs)
 
-    def extendMarkdown(self, md, md_globals):
-        processor = KillTagsPostprocessor(md)
-        processor.config = self.getConfigs()
-        md.postprocessors.add("kill_tags", processor, "_end")
-        # md.registerExtension(self)
+    def simple_selectors(self, config):
+        """Return the parsed `kill` selectors, or None if some are not simple."""
+        if config["kill_known"]:
+            return None
+        selectors = []
+        for selector in config["kill"]:
+            parsed = parse_simple(selector)
+            if parsed is None:
+                return None
+            selectors.extend(parsed)
+        return selectors
+
+    def extendMarkdown(self, md):
+        config = self.getConfigs()
+        normalizer(config["normalize"])  # fail early on unknown backends
+        if config["mode"] not in ("postprocessor", "tree"):
+            raise ValueError(
+                "mode must be postprocessor or tree, not {!r}".format(config["mode"])
+            )
+        selectors = self.simple_selectors(config)
+        if config["mode"] == "tree":
+            tree_selectors = [
+                parsed
+                for selector in config["kill"]
+                for parsed in parse_simple(selector) or ()
+            ]
+            md.treeprocessors.register(
+                KillTagsTreeprocessor(md, config, tree_selectors), "kill_tags", 15
+            )
+        stream = (
+            config["stream"]
+            and selectors is not None
+            and normalizer(config["normalize"]) is None
+        )
+        if config["stream"] and not stream:
+            logger.warning("kill_tags: cannot stream this configuration")
+        if stream:
+            processor = KillTagsStreamPostprocessor(md, config, selectors)
+            md.postprocessors.register(processor, "kill_tags", STAGE_PRIORITY + 1)
+        else:
+            processor = KillTagsPostprocessor(md)
+            processor.config = config
+            processor.compile_selectors()
+            get_dom_stage(md).processors.register(processor, "kill_tags", 20)
+        # the treeprocessor handles everything but the raw HTML
+        processor.raw_html_only = config["mode"] == "tree" and selectors is not None
 
 
 def makeExtension(*args, **kwargs):
@@ -21,12 +21,58 @@ pip install --user --upgrade git+https://github.com/twardoch/markdown-steroids.g
     include_base    : '.'        # Default location from which to evaluate relative paths for the `<%include file="..."/>` statement.
     include_encoding: 'utf-8'    # Encoding of the files used by the `<%include file="..."/>` statement.
     include_auto    : 'head.md'  # Path to Mako file to be automatically included at the beginning.
-    python_block    : 'head.py'  # Path to Python file to be automatically included at the beginning as a module block. Useful for global imports and functions.
+    python_block    : 'head.py'  # Path to Python module whose public names (imports, functions, constants) are available in every document.
+    template_cache  : true       # Keep compiled templates in memory, keyed on a hash of the template source and options.
+    module_directory: ''         # Directory where compiled templates are also stored as Python modules, to be reused across builds.
+    filesystem_checks: true      # Recompile included templates when their files change. Turn off for one-off builds.
+    collection_size : -1         # Maximum number of included templates kept compiled; -1 keeps all.
     meta:                        # Dict of args passed to `mako.Template().render()`. Can be overriden through Markdown YAML metadata.
       author        : 'John Doe' # Can be referred inside the Markdown via `${author}`
       status        : 'devel'    # Can be referred inside the Markdown via `${status}`
 ```
 
+### Template cache
+
+Compiling a template (lexing, parsing, generating and compiling Python code)
+usually costs more than rendering it. Compiled templates are therefore kept
+in a process-wide LRU cache of `TEMPLATE_CACHE_SIZE` entries, keyed on a hash
+of the final template source (with the `include_auto` line) and of the
+options that affect compilation. A document that has not
+changed since the last conversion is rendered without compiling it again.
+
+With `module_directory`, compiled templates are also written there as Python
+modules named after the hash, so later builds in new processes load them
+instead of compiling them. Stale modules are never reused, because a changed
+source has a different hash; the directory can be cleared at any time.
+
+Included templates (`include_auto` and `<%include file="..."/>`) are
+compiled by one `TemplateLookup` per extension instance, which keeps them
+across documents: a `head.md` shared by thousands of pages is read and
+compiled once. The lookup checks the modification time of an included file
+at each use unless `filesystem_checks` is off, and keeps at most
+`collection_size` included templates.
+
+The `python_block` file is executed once as a Python module and reloaded
+only when its modification time changes. Its public names are passed to
+every template as render arguments, taking precedence over `meta`, instead
+of being compiled into each document as a `<%! %>` block.
+
+### Batch rendering
+
+`render_many()` renders many documents through Mako only, across a process
+pool, and yields the rendered Markdown in input order. Every worker keeps
+its own lookup and compiled templates for all of its documents, and loads
+the `include_auto` template and the `python_block` module once, when it
+starts.
+
+```python
+from mdx_steroids.md_mako import render_many
+
+config = {"include_base": "templates", "include_auto": "head.md"}
+for text in render_many(paths, config, workers=8):
+    ...
+```
+
 ### Example
 
 This assumes that the `meta` or `mdx_steroids.meta_yaml` extension is enabled,
@@ -76,14 +122,137 @@ License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
 
 __version__ = "0.5.0"
 
+import collections
+import hashlib
+import importlib.util
+import itertools
+import json
 import os.path
 import re
+import tempfile
+import threading
+import types
 
+import mako
 from mako.lookup import TemplateLookup
-from mako.template import Template
+from mako.template import ModuleTemplate, Template
 from markdown import Extension
 from markdown.preprocessors import Preprocessor
 
+from .batch import map_ordered, read_source
+
+TEMPLATE_CACHE_SIZE = 256
+
+
+class TemplateCache:
+    """LRU mapping of template keys to compiled template modules."""
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self._modules = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            module = self._modules.get(key)
+            if module is not None:
+                self._modules.move_to_end(key)
+            return module
+
+    def put(self, key, module):
+        with self._lock:
+            self._modules[key] = module
+            self._modules.move_to_end(key)
+            while len(self._modules) > self.size:
+                self._modules.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._modules.clear()
+
+    def __len__(self):
+        return len(self._modules)
+
+
+_templates = TemplateCache()
+
+
+def template_key(source, options):
+    """Return a hex digest of the template source and its compile options."""
+    digest = hashlib.blake2b(digest_size=16)
+    versions = [__version__, mako.__version__]
+    digest.update(json.dumps([versions, options], sort_keys=True).encode("utf-8"))
+    digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_module(key, module_directory):
+    """Load the compiled template stored under `key`, or return None."""
+    path = os.path.join(module_directory, f"md_mako_{key}.py")
+    if not os.path.exists(path):
+        return None
+    spec = importlib.util.spec_from_file_location(f"md_mako_{key}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def store_module(key, module_directory, code):
+    """Write the Python source of a compiled template under `key`."""
+    os.makedirs(module_directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".md_mako_", dir=module_directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(code)
+        os.replace(tmp_path, os.path.join(module_directory, f"md_mako_{key}.py"))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+_python_blocks = {}
+_python_blocks_lock = threading.Lock()
+
+
+def load_python_block(path):
+    """Return the names of the module at `path`, run once per file version.
+
+    All names but dunders reach the templates, as they did when the file
+    was inlined into each template, including `_` and `_helper` functions.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _python_blocks_lock:
+        loaded = _python_blocks.get(path)
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        with open(path, encoding="utf-8") as f:
+            code = compile(f.read(), path, "exec")
+        module = types.ModuleType(os.path.splitext(os.path.basename(path))[0])
+        module.__file__ = path
+        exec(code, module.__dict__)
+        namespace = {
+            k: v
+            for k, v in vars(module).items()
+            if not (k.startswith("__") and k.endswith("__"))
+        }
+        _python_blocks[path] = (mtime, namespace)
+        return namespace
+
+
+_escaped = {}
+
+
+def _escape_mako_syntax(match):
+    # A callback is faster than the equivalent r"${'\g<0>'}" template, and
+    # reusing the few distinct replacements avoids one string per match.
+    text = match.group()
+    escaped = _escaped.get(text)
+    if escaped is None:
+        escaped = _escaped[text] = "${'" + text + "'}"
+    return escaped
+
 
 class MakoPreprocessor(Preprocessor):
     # Mako interprets `##` at the beginning of a line as a comment,
@@ -91,72 +260,175 @@ class MakoPreprocessor(Preprocessor):
     # passing the content to Mako, we replace the initial `##`
     # with a fake string, and after the Mako processing
     # we change it back.
-    re_mako_skip_conflicting_syntax1 = re.compile(r"^([#]+)", re.M)
-    re_mako_skip_conflicting_syntax2 = re.compile(r"^({%)", re.M)
-    re_mako_skip_conflicting_syntax3 = re.compile(r"^(%})", re.M)
+    # The same applies to `{%` and `%}` at the start of a line. All three
+    # are matched by one pattern, so the escaping is a single pass.
+    re_mako_skip_conflicting_syntax = re.compile(r"^(?:#+|\{%|%\})", re.M)
 
-    def __init__(self, config, md):
+    def __init__(self, config, md, lookup=None):
         super().__init__(md)
         self.mako_args = config.get("meta")
         self.mako_include_base = config.get("include_base")
         self.mako_include_encoding = config.get("include_encoding")
         self.mako_include_auto = config.get("include_auto")
         self.mako_python_block = config.get("python_block")
+        self.template_cache = config.get("template_cache")
+        self.module_directory = config.get("module_directory")
         if type(self.mako_include_base) is list:
             self.mako_base_dirs = self.mako_include_base
         else:
             self.mako_base_dirs = [self.mako_include_base]
+        self.lookup = lookup or make_lookup(config)
 
-    def keep_markdown_headings(self, md):
-        md = self.re_mako_skip_conflicting_syntax1.sub(r"${'\1'}", md)
-        md = self.re_mako_skip_conflicting_syntax2.sub(r"${'\1'}", md)
-        md = self.re_mako_skip_conflicting_syntax3.sub(r"${'\1'}", md)
-        return md
+    @classmethod
+    def keep_markdown_headings(cls, md):
+        return cls.re_mako_skip_conflicting_syntax.sub(_escape_mako_syntax, md)
 
-    def run(self, lines):
-        if self.mako_python_block:
-            path_python_block = None
-            if os.path.exists(self.mako_python_block):
-                path_python_block = self.mako_python_block
-            elif os.path.exists(
-                os.path.join(self.mako_include_base[0], self.mako_python_block)
-            ):
-                path_python_block = os.path.join(
-                    self.mako_include_base[0], self.mako_python_block
-                )
-            if path_python_block:
-                with open(path_python_block, encoding="utf8") as f:
-                    python_block = f.read().splitlines()
-                lines = ["<%!"] + python_block + ["%>"] + lines
-            else:
-                lines = [""] + lines
+    def compile_template(self, source):
+        """Return the compiled module of `source`, from the caches if possible."""
+        options = {
+            "input_encoding": self.mako_include_encoding,
+            "strict_undefined": True,
+        }
+        key = template_key(source, options)
+        module = _templates.get(key) if self.template_cache else None
+        if module is None and self.module_directory:
+            module = load_module(key, self.module_directory)
+        if module is None:
+            template = Template(
+                source,
+                input_encoding=self.mako_include_encoding,
+                strict_undefined=True,
+                preprocessor=self.keep_markdown_headings,
+            )
+            module = template.module
+            if self.module_directory:
+                store_module(key, self.module_directory, template.code)
+        if self.template_cache:
+            _templates.put(key, module)
+        return module
+
+    def python_block(self):
+        """Return the names defined by the `python_block` file, if it exists."""
+        if not self.mako_python_block:
+            return {}
+        for path in (
+            self.mako_python_block,
+            os.path.join(self.mako_base_dirs[0], self.mako_python_block),
+        ):
+            try:
+                return load_python_block(path)
+            except FileNotFoundError:
+                pass
+        return {}
+
+    def preload(self):
+        """Compile the `include_auto` template and load the `python_block`."""
         if self.mako_include_auto:
-            line_include_auto = f'<%include file="{self.mako_include_auto}"/>'
-            lines = [line_include_auto] + lines
-        md = "\n".join(lines)
-        mako_args = self.mako_args
-        if hasattr(self.markdown, "Meta"):
-            md_meta = {
+            self.lookup.get_template(self.mako_include_auto)
+        self.python_block()
+
+    def run(self, lines):
+        meta = None
+        if hasattr(self.md, "Meta"):
+            meta = {
                 k.lower(): "".join(v) if isinstance(v, list) else v
-                for k, v in self.markdown.Meta.items()
+                for k, v in self.md.Meta.items()
             }
-            assert isinstance(mako_args, dict)
-            mako_args.update(md_meta)
-        mako_lookup = TemplateLookup(
-            directories=self.mako_base_dirs, strict_undefined=True
-        )
-        mako_tpl = Template(
-            md,
-            input_encoding=self.mako_include_encoding,
-            lookup=mako_lookup,
-            strict_undefined=True,
-            preprocessor=self.keep_markdown_headings,
+        return self.render(lines, meta)
+
+    def render(self, lines, meta=None):
+        """Render the lines of a document with the `meta` option and `meta`."""
+        prefix = ()
+        if self.mako_include_auto:
+            prefix = (f'<%include file="{self.mako_include_auto}"/>',)
+        md = "\n".join(itertools.chain(prefix, lines))
+        mako_args = dict(self.mako_args)
+        if meta:
+            mako_args.update(meta)
+        mako_args.update(self.python_block())
+        mako_tpl = ModuleTemplate(
+            self.compile_template(md), template_source=md, lookup=self.lookup
         )
-        mako_result = str(mako_tpl.render(**mako_args))
-        lines = mako_result.splitlines()[1:]
+        lines = mako_tpl.render(**mako_args).splitlines()
+        # drop the line left by the include_auto prefix, in place
+        del lines[: len(prefix)]
         return lines
 
 
+_renderer = None
+
+
+def _init_render_worker(config):
+    global _renderer
+    _renderer = MakoPreprocessor(config, None)
+    _renderer.preload()
+
+
+def _render(renderer, item):
+    source, meta = item if isinstance(item, tuple) else (item, None)
+    return "\n".join(renderer.render(read_source(source).split("\n"), meta))
+
+
+def _render_in_worker(item):
+    return _render(_renderer, item)
+
+
+def render_many(sources, config=None, workers=1):
+    """Render many documents through Mako, yielding Markdown in input order.
+
+    Each worker process renders with its own `TemplateLookup` and compiled
+    template cache, which stay warm for all of its documents. The
+    `include_auto` template and the `python_block` module are loaded by the
+    worker initializer, before the first document.
+
+    Args:
+        sources: Documents, each Markdown text, a path-like object read as
+            UTF-8, or a `(source, meta)` pair whose `meta` dict is merged
+            into the `meta` option for that document
+        config: md_mako options, as in `extension_configs`
+        workers: Number of worker processes; 1 renders in this process
+
+    Yields:
+        The rendered Markdown of each document
+    """
+    config = MarkdownMakoExtension(**(config or {})).getConfigs()
+    if workers <= 1:
+        renderer = MakoPreprocessor(config, None)
+        renderer.preload()
+        for item in sources:
+            yield _render(renderer, item)
+        return
+    yield from map_ordered(
+        _render_in_worker, sources, workers, _init_render_worker, (config,)
+    )
+
+
+def _reset_locks():
+    # A lock held by another thread at fork time would stay locked forever
+    # in the child, so worker processes start with fresh ones.
+    global _python_blocks_lock
+    _python_blocks_lock = threading.Lock()
+    _templates._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)
+
+
+def make_lookup(config):
+    """Create the lookup that compiles and keeps the included templates."""
+    base_dirs = config.get("include_base")
+    return TemplateLookup(
+        directories=base_dirs if type(base_dirs) is list else [base_dirs],
+        input_encoding=config.get("include_encoding"),
+        strict_undefined=True,
+        preprocessor=MakoPreprocessor.keep_markdown_headings,
+        filesystem_checks=config.get("filesystem_checks"),
+        collection_size=config.get("collection_size"),
+        module_directory=config.get("module_directory") or None,
+    )
+
+
 class MarkdownMakoExtension(Extension):
     def __init__(self, *args, **kwargs):
         self.config = {
@@ -175,8 +447,26 @@ class MarkdownMakoExtension(Extension):
             ],
             "python_block": [
                 "",
-                "Path to Python file to be automatically"
-                "included at the beginning as a module block.",
+                "Path to Python module whose public names "
+                "are available in every document.",
+            ],
+            "template_cache": [
+                True,
+                "Keep compiled templates in memory, keyed on a hash "
+                "of the template source and options.",
+            ],
+            "module_directory": [
+                "",
+                "Directory where compiled templates are stored as "
+                "Python modules, to be reused across builds.",
+            ],
+            "filesystem_checks": [
+                True,
+                "Recompile included templates when their files change.",
+            ],
+            "collection_size": [
+                -1,
+                "Maximum number of included templates kept compiled; -1 keeps all.",
             ],
             "meta": [
                 {},
@@ -185,12 +475,15 @@ class MarkdownMakoExtension(Extension):
             ],
         }
         super().__init__(*args, **kwargs)
+        self.lookup = None
 
     def extendMarkdown(self, md):
         self.md = md
         md.registerExtension(self)
         config = self.getConfigs()
-        md_mako = MakoPreprocessor(config, md)
+        if self.lookup is None:
+            self.lookup = make_lookup(config)
+        md_mako = MakoPreprocessor(config, md, self.lookup)
         md.preprocessors.register(md_mako, "md_mako", 980)
 
 
@@ -18,11 +18,27 @@ pip install --user --upgrade git+https://github.com/twardoch/markdown-steroids.g
 
 * The `add` option allows to specify a list of CSS selectors or (when using the "!" prefix), XPath selectors. Elements matching to these selectors will get the `translate="no"` attribute.
 
-* The `normalize` option will pass the final HTML through BeautifulSoup if true.
+* The `normalize` option passes the HTML through a normalizing parser before and after processing:
+`html5lib` (BeautifulSoup with html5lib, also selected by `true`), `lxml` (much faster), `html5-parser`
+(fast and spec-compliant, needs `pip install html5-parser`) or `none` (the default, also selected by `false`).
+
+The HTML is parsed once per conversion by the DOM stage shared with
+`mdx_steroids.kill_tags` (see `mdx_steroids.dom`); elements are removed
+before they are tagged. Selectors are compiled once per process and shared
+by all `Markdown` instances. Documents in which a quick text search finds
+none of the targeted tags or classes are returned unchanged, without being
+parsed.
+
+* The `mode` option set to `tree` tags the elements in the Python-Markdown tree, before it is
+serialized, so no HTML is parsed. This covers type, class, id and attribute selectors, optionally
+joined by descendant or child combinators. If some `add` selectors are not of this kind, or if raw
+HTML in the document may contain matching elements, the final HTML is also processed as in the
+default `postprocessor` mode. Note that fenced code blocks are stored as raw HTML by Python-Markdown.
 
 ```yaml
   mdx_steroids.translate_no:
-    normalize: false  # Do not use BeautifulSoup for post-processing
+    normalize: none   # Or html5lib, lxml, html5-parser
+    mode: postprocessor # Or tree
     add:             # List of CSS selectors or (with "!" prefix) XPath selectors
       - kbd
       - code
@@ -33,73 +49,142 @@ Copyright (c) 2017 Adam Twardoch <adam+github@twardoch.com>
 License: [BSD 3-clause](https://opensource.org/licenses/BSD-3-Clause)
 """
 
-from future.utils import bytes_to_native_str as n
-
 __version__ = "0.5.4"
 
-import lxml.cssselect as cssselect
-import lxml.etree as et
-import lxml.html
-import lxml.html.soupparser
-from bs4 import BeautifulSoup
 from markdown import Extension
-from markdown.postprocessors import Postprocessor
+from markdown.treeprocessors import Treeprocessor
+
+from .dom import (
+    DomProcessor,
+    SelectorMatcher,
+    compile_prefilter,
+    compile_selector,
+    get_dom_stage,
+    normalizer,
+    parse_simple,
+    selector_to_xpath,
+)
+
 
+class NoTranslatePostprocessor(DomProcessor):
+    selectors = None
 
-class NoTranslatePostprocessor(Postprocessor):
     def add_attribute_to_element(self, element):
         element.attrib["translate"] = "no"
         element.classes.add("notranslate")
 
-    def normalize_html(self):
-        out = BeautifulSoup(self.html, "html5lib")
-        self.html = str(out)
-
     def parse_selector(self, selector):
-        cx = cssselect.LxmlHTMLTranslator()
-        if selector[:1] == "!":  # direct XPath selector
-            xpath_sel = selector[1:]
-        else:
-            xpath_sel = cx.css_to_xpath(selector)  # CSS selector
-        return xpath_sel
-
-    def process_selectors(self):
-        tree = lxml.html.fromstring(self.html)
+        return selector_to_xpath(selector)
+
+    def compile_selectors(self):
+        """Compile the configured selectors once, through the shared cache."""
+        selectors = tuple(self.config.get("add", []))
+        self.selectors = [compile_selector(sel) for sel in selectors]
+        self.prefilter = compile_prefilter(selectors)
+
+    def process_selectors(self, tree):
         for process_selector in self.selectors:
-            for el in tree.xpath(process_selector):
+            for el in process_selector(tree):
                 self.add_attribute_to_element(el)
-        out = n(et.tostring(tree, pretty_print=False))
-        self.html = str(out)
-
-    def run(self, html):
-        self.html = html
-        self.selectors = [
-            self.parse_selector(sel) for sel in self.config.get("add", [])
-        ]
-        if self.config.get("normalize", False):
-            self.normalize_html()
-        self.process_selectors()
-        if self.config.get("normalize", False):
-            self.normalize_html()
-        return str(self.html)
+
+    def run_tree(self, tree):
+        if self.selectors is None:
+            self.compile_selectors()
+        self.process_selectors(tree)
+
+
+class _AppendedKey(str):
+    """Attribute name that Python-Markdown serializes after the existing ones.
+
+    The serializer writes attributes in lexical order, while lxml, in the
+    postprocessor, keeps them in insertion order. Added names sort after
+    all others, in the order they were added, so both modes produce the
+    same HTML.
+    """
+
+    def __new__(cls, name, rank):
+        key = super().__new__(cls, name)
+        key.rank = rank
+        return key
+
+    def __lt__(self, other):
+        return isinstance(other, _AppendedKey) and self.rank < other.rank
+
+    def __gt__(self, other):
+        return not isinstance(other, _AppendedKey) or self.rank > other.rank
+
+
+TRANSLATE = _AppendedKey("translate", 0)
+CLASS = _AppendedKey("class", 1)
+
+
+class NoTranslateTreeprocessor(Treeprocessor):
+    """Tag matching elements in the Python-Markdown tree, before serialization."""
+
+    def __init__(self, md, selectors):
+        super().__init__(md)
+        self.matcher = SelectorMatcher(selectors)
+
+    def add_attribute_to_element(self, element):
+        # as in the postprocessor: translate first, then class; existing
+        # attributes keep their place
+        element.set("translate" if "translate" in element.attrib else TRANSLATE, "no")
+        if "class" not in element.attrib:
+            element.set(CLASS, "notranslate")
+            return
+        classes = element.get("class").split()
+        if "notranslate" not in classes:
+            element.set("class", " ".join(classes + ["notranslate"]))
+
+    def run(self, root):
+        for el in list(self.matcher.iter_matches(root)):
+            self.add_attribute_to_element(el)
 
 
 class NoTranslateExtensions(Extension):
     def __init__(self, *args, **kwargs):
         self.config = {
-            "normalize": [False, "Normalize HTML"],
+            "normalize": [
+                "none",
+                "Normalize HTML with html5lib, lxml, html5-parser or none",
+            ],
             "add": [
                 ["code", "mark", "pre", "kbd"],
                 'List of element CSS selectors where translate="no" is added',
             ],
+            "mode": [
+                "postprocessor",
+                "Tag elements in the final HTML (postprocessor) or in the "
+                "Markdown tree before serialization (tree)",
+            ],
         }
         super().__init__(*args, **kwargs)
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         processor = NoTranslatePostprocessor(md)
         processor.config = self.getConfigs()
-        md.postprocessors.add("translate_no", processor, "_end")
-        # md.registerExtension(self)
+        normalizer(processor.config["normalize"])  # fail early on unknown backends
+        processor.compile_selectors()
+        if processor.config["mode"] == "tree":
+            selectors = []
+            fallback = False
+            for selector in processor.config["add"]:
+                parsed = parse_simple(selector)
+                if parsed is None:
+                    fallback = True
+                else:
+                    selectors.extend(parsed)
+            md.treeprocessors.register(
+                NoTranslateTreeprocessor(md, selectors), "translate_no", 5
+            )
+            processor.raw_html_only = not fallback
+        elif processor.config["mode"] != "postprocessor":
+            raise ValueError(
+                "mode must be postprocessor or tree, not {!r}".format(
+                    processor.config["mode"]
+                )
+            )
+        get_dom_stage(md).processors.register(processor, "translate_no", 10)
 
 
 def makeExtension(*args, **kwargs):
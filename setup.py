@@ -97,6 +97,10 @@ setup(
         "cssselect>=1.0.1",  # Usually stable
         "lxml>=3.8.0",  # Usually stable, but check Python 3 specifics
         "beautifulsoup4>=4.6.0",  # Usually stable
+        "pyyaml>=5.1",  # Used by meta_yaml and the mdx-steroids build config
     ],
+    entry_points={
+        "console_scripts": ["mdx-steroids=mdx_steroids.cli:main"],
+    },
     python_requires=">=3.8",  # Specify minimum Python version
 )
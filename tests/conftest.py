@@ -0,0 +1,42 @@
+# this_file: tests/conftest.py
+"""Image factories shared by the img_* tests."""
+
+import io
+import struct
+import zlib
+
+import pytest
+
+
+def _write_png(path, width, height):
+    """Write a minimal valid grayscale PNG of the given size."""
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    raw = b"".join(b"\x00" + b"\x00" * width for _ in range(height))
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
+
+
+@pytest.fixture
+def write_png():
+    """Return a function that writes a PNG file without needing Pillow."""
+    return _write_png
+
+
+@pytest.fixture
+def pil_image():
+    """Return a function that encodes an image with Pillow, or skip the test."""
+    Image = pytest.importorskip("PIL.Image")
+
+    def encode(fmt, size=(123, 45), **kwargs):
+        buf = io.BytesIO()
+        Image.new("RGB", size, (200, 10, 10)).save(buf, fmt, **kwargs)
+        return buf.getvalue()
+
+    return encode
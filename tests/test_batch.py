@@ -0,0 +1,59 @@
+# this_file: tests/test_batch.py
+"""Tests for batch conversion with pooled Markdown instances."""
+
+from unittest.mock import patch
+
+import markdown
+import pytest
+
+from mdx_steroids import batch
+from mdx_steroids.batch import MarkdownPool, convert_many
+
+EXTENSIONS = ["footnotes", "toc", "mdx_steroids.kill_tags", "mdx_steroids.translate_no"]
+CONFIGS = {
+    "mdx_steroids.kill_tags": {"kill": ["del"]},
+    "mdx_steroids.translate_no": {"add": ["code"]},
+}
+TEXTS = [
+    "# One\n\nText[^a] with <del>gone</del>.\n\n[^a]: Note one.\n",
+    "# Two\n\nSome `code`.\n",
+    "# One\n\nAgain[^b].\n\n[^b]: Note two.\n",
+]
+
+
+def fresh(text):
+    return markdown.markdown(text, extensions=EXTENSIONS, extension_configs=CONFIGS)
+
+
+def test_convert_many_matches_fresh_instances():
+    expected = [fresh(text) for text in TEXTS]
+    assert list(convert_many(TEXTS, EXTENSIONS, CONFIGS)) == expected
+
+
+def test_pool_sets_up_extensions_once():
+    pool = MarkdownPool(EXTENSIONS, CONFIGS)
+    with patch.object(pool, "create", wraps=pool.create) as create:
+        for text in TEXTS * 3:
+            pool.convert(text)
+    assert create.call_count == 1
+
+
+def test_convert_many_reads_paths(tmp_path):
+    paths = []
+    for i, text in enumerate(TEXTS):
+        path = tmp_path / f"{i}.md"
+        path.write_text(text, encoding="utf-8")
+        paths.append(path)
+    assert list(convert_many(paths, EXTENSIONS, CONFIGS)) == [fresh(t) for t in TEXTS]
+
+
+def test_convert_many_workers_keep_order():
+    texts = [f"# Doc {i}\n\nBody `{i}`.\n" for i in range(40)]
+    expected = [fresh(text) for text in texts]
+    assert list(convert_many(texts, EXTENSIONS, CONFIGS, workers=2)) == expected
+
+
+def test_uninitialized_worker_raises(monkeypatch):
+    monkeypatch.setattr(batch, "_worker_pool", None)
+    with pytest.raises(RuntimeError, match="not initialized"):
+        batch._convert_in_worker("text")
@@ -0,0 +1,69 @@
+# this_file: tests/test_cli.py
+"""Tests for the mdx-steroids command-line tool."""
+
+import markdown
+import pytest
+
+from mdx_steroids import cli
+from mdx_steroids.cli import load_config, main
+
+CONFIG = """\
+mdx_steroids.kill_tags:
+  kill: [del]
+mdx_steroids.keys:
+"""
+EXTENSIONS = ["mdx_steroids.kill_tags", "mdx_steroids.keys"]
+CONFIGS = {"mdx_steroids.kill_tags": {"kill": ["del"]}, "mdx_steroids.keys": {}}
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "index.md").write_text("# Home\n\nText <del>gone</del>.\n")
+    (src / "sub" / "keys.markdown").write_text("Press ++ctrl+s++.\n")
+    (src / "sub" / "notes.txt").write_text("not markdown\n")
+    for i in range(20):
+        (src / f"page{i:02}.md").write_text(f"# Page {i}\n\n++cmd+{i}++\n")
+    config = tmp_path / "steroids.yml"
+    config.write_text(CONFIG)
+    return src, config, tmp_path / "out"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_build_writes_html_tree(tree, workers, capsys):
+    src, config, out = tree
+    args = ["build", str(src), "-c", str(config), "-o", str(out), "-j", str(workers)]
+    assert main(args) == 0
+    written = sorted(p.relative_to(out).as_posix() for p in out.rglob("*.html"))
+    assert len(written) == 22 and "sub/keys.html" in written
+    for name in ("index", "sub/keys", "page07"):
+        source = next(src.glob(name + ".*")).read_text()
+        expected = markdown.markdown(
+            source, extensions=EXTENSIONS, extension_configs=CONFIGS
+        )
+        assert (out / (name + ".html")).read_text() == expected
+    stats = capsys.readouterr().err
+    assert "22 docs" in stats and "docs/s" in stats and "MB/s" in stats
+    assert "mdx_steroids.keys" in stats and "markdown" in stats
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        CONFIG,
+        "- mdx_steroids.kill_tags:\n    kill: [del]\n- mdx_steroids.keys\n",
+        "site_name: x\nmarkdown_extensions:\n"
+        "  - mdx_steroids.kill_tags:\n      kill: [del]\n  - mdx_steroids.keys\n",
+    ],
+)
+def test_load_config_shapes(tmp_path, text):
+    path = tmp_path / "config.yml"
+    path.write_text(text)
+    assert load_config(str(path)) == (EXTENSIONS, CONFIGS)
+
+
+def test_uninitialized_worker_raises(monkeypatch, tmp_path):
+    monkeypatch.setattr(cli, "_worker_pool", None)
+    with pytest.raises(RuntimeError, match="not initialized"):
+        cli._build_one((str(tmp_path / "a.md"), str(tmp_path / "a.html")))
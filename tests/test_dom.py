@@ -0,0 +1,203 @@
+# this_file: tests/test_dom.py
+"""Tests for the DOM stage shared by kill_tags and translate_no."""
+
+import subprocess
+import sys
+from unittest.mock import patch
+
+import lxml.html
+import markdown
+import pytest
+
+from mdx_steroids.dom import DomStage
+
+TEXT = """# Title
+
+Some `code` and <del>deleted</del> text.
+
+<div class="ad">Advertisement</div>
+
+<p></p>
+"""
+
+CONFIGS = {
+    "mdx_steroids.kill_tags": {"kill": ["del", ".ad"]},
+    "mdx_steroids.translate_no": {"add": ["code", "h1"]},
+}
+
+
+def convert(extensions):
+    return markdown.markdown(TEXT, extensions=extensions, extension_configs=CONFIGS)
+
+
+def test_one_parse_for_both_extensions():
+    extensions = ["mdx_steroids.kill_tags", "mdx_steroids.translate_no"]
+    with patch("lxml.html.fromstring", wraps=lxml.html.fromstring) as parse:
+        html = convert(extensions)
+    assert parse.call_count == 1
+    assert "deleted" not in html and "Advertisement" not in html
+    assert '<code translate="no" class="notranslate">code</code>' in html
+    assert '<h1 translate="no" class="notranslate">Title</h1>' in html
+    assert "<p></p>" not in html
+
+
+def test_same_output_as_separate_passes():
+    kill = convert(["mdx_steroids.kill_tags"])
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.translate_no"], extension_configs=CONFIGS
+    )
+    assert md.postprocessors["steroids_dom"].run(kill) == convert(
+        ["mdx_steroids.translate_no", "mdx_steroids.kill_tags"]
+    )
+
+
+def test_stage_registered_once():
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.kill_tags", "mdx_steroids.translate_no"]
+    )
+    stages = [p for p in md.postprocessors if isinstance(p, DomStage)]
+    assert len(stages) == 1
+    assert [type(p).__name__ for p in stages[0].processors] == [
+        "KillTagsPostprocessor",
+        "NoTranslatePostprocessor",
+    ]
+
+
+def test_selectors_compiled_once():
+    from mdx_steroids.dom import compile_selector
+
+    compile_selector.cache_clear()
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.translate_no"], extension_configs=CONFIGS
+    )
+    with patch("lxml.cssselect.LxmlHTMLTranslator.css_to_xpath") as translate:
+        for _ in range(3):
+            md.reset().convert(TEXT)
+            markdown.markdown(
+                TEXT,
+                extensions=["mdx_steroids.translate_no"],
+                extension_configs=CONFIGS,
+            )
+    translate.assert_not_called()
+    assert compile_selector("code") is compile_selector("code")
+    assert compile_selector.cache_info().currsize == 2
+
+
+def test_parse_simple():
+    from mdx_steroids.dom import parse_simple
+
+    tree = lxml.html.fromstring(
+        '<div><pre class="highlight"><code class="language-del x">a</code></pre>'
+        '<p lang="en-US"><code class="language-del">b</code></p></div>'
+    )
+
+    def matched(selector):
+        selectors = parse_simple(selector)
+        return [
+            el.text
+            for el in tree.iter("code")
+            if any(s.matches(el, list(el.iterancestors())) for s in selectors)
+        ]
+
+    assert matched("pre > code.language-del") == ["a"]
+    assert matched("div code") == ["a", "b"]
+    assert matched("div > code") == []
+    assert matched("[lang|=en] code, .x") == ["a", "b"]
+    for unsupported in ("h1 + p", "p:first-child", "p::before", "!//p"):
+        assert parse_simple(unsupported) is None
+
+
+def test_prefilter_skips_parsing():
+    from mdx_steroids.dom import compile_prefilter
+
+    prefilter = compile_prefilter(("del", "code.language-del"), ("p", "div"))
+    assert not prefilter.search('<p>Text <span class="language">x</span></p>')
+    assert prefilter.search("<p>Text <DEL>x</DEL></p>")
+    assert prefilter.search('<pre><code class="language-del">x</code></pre>')
+    assert prefilter.search("<div>\n<p>x</p></div>")
+    assert prefilter.search("<p>&#32;</p>")
+    assert prefilter.search('<p><div class="x">Text</div>')
+    assert not prefilter.search('<p class="x"></p><div id="a">Text</div>')
+    assert compile_prefilter(("!//del",)) is None
+    assert compile_prefilter(("*",)) is None
+
+    text = "# Title\n\nPlain *text* & more.\n\n<div class=\"x\">\n<p>Raw</p>\n</div>"
+    extensions = ["mdx_steroids.kill_tags", "mdx_steroids.translate_no"]
+    with patch("lxml.html.fromstring", wraps=lxml.html.fromstring) as parse:
+        html = markdown.markdown(text, extensions=extensions)
+    parse.assert_not_called()
+    assert html == markdown.markdown(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        TEXT,
+        "<p>&#32;</p>\n\nText",
+        "<p>&#x20;&#9;</p>\n\n<p>&nbsp;</p>",
+        '<section><p><div class="x">Block</div></section>',
+        "<div>\n<p><!-- note --></p>\n</div>",
+        '<p class="x"></p>\n\n<div id="a">Text <del>x</del></div>',
+        "# Title\n\n* item\n\n<pre>\n</pre>",
+    ],
+)
+def test_prefilter_keeps_output(text):
+    """Test that the prefilter only skips documents the DOM stage leaves as is."""
+    config = {"mdx_steroids.kill_tags": {"kill": ["del"]}}
+    filtered = markdown.markdown(
+        text, extensions=["mdx_steroids.kill_tags"], extension_configs=config
+    )
+    with patch("mdx_steroids.dom.DomProcessor._search", return_value=True):
+        unfiltered = markdown.markdown(
+            text, extensions=["mdx_steroids.kill_tags"], extension_configs=config
+        )
+    assert filtered == unfiltered
+
+
+@pytest.mark.parametrize("backend", ["html5lib", "lxml", "html5-parser"])
+def test_normalizers_agree(backend):
+    from mdx_steroids.dom import NORMALIZERS
+
+    if backend == "html5-parser":
+        pytest.importorskip("html5_parser")
+    html = "<p>One <b>bold</b><p>Two &amp; <i>three</i><ul><li>a<li>b</ul><br>"
+    normalized = NORMALIZERS[backend](html)
+    body = lxml.html.document_fromstring(normalized).body
+    assert [(el.tag, el.text) for el in body.iter()] == [
+        ("body", None),
+        ("p", "One "),
+        ("b", "bold"),
+        ("p", "Two & "),
+        ("i", "three"),
+        ("ul", None),
+        ("li", "a"),
+        ("li", "b"),
+        ("br", None),
+    ]
+
+
+def test_normalize_option():
+    html = markdown.markdown(
+        TEXT,
+        extensions=["mdx_steroids.kill_tags"],
+        extension_configs={"mdx_steroids.kill_tags": {"kill": ["del"], "normalize": "lxml"}},
+    )
+    assert html.startswith("<html><body>") and "deleted" not in html
+    with pytest.raises(ValueError):
+        markdown.Markdown(
+            extensions=["mdx_steroids.translate_no"],
+            extension_configs={"mdx_steroids.translate_no": {"normalize": "tidy"}},
+        )
+
+
+def test_bs4_imported_lazily():
+    code = (
+        "import sys, markdown\n"
+        "markdown.markdown('<del>x</del> `y`', extensions=["
+        "'mdx_steroids.kill_tags', 'mdx_steroids.translate_no'])\n"
+        "print('bs4' in sys.modules, 'html5lib' in sys.modules)\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.split() == ["False", "False"]
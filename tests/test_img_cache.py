@@ -0,0 +1,223 @@
+# this_file: tests/test_img_cache.py
+"""Tests for the img_smart dimension cache."""
+
+import json
+import multiprocessing
+import os
+from unittest.mock import patch
+
+import markdown
+import pytest
+
+from mdx_steroids import img_cache
+from mdx_steroids.batch import convert_many
+from mdx_steroids.img_cache import DimensionCache, SQLiteDimensionCache, get_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    img_cache._caches.clear()
+    yield
+    img_cache._caches.clear()
+
+
+def convert(text, cache_path, **config):
+    config["cache"] = cache_path
+    return markdown.markdown(
+        text,
+        extensions=["mdx_steroids.img_smart"],
+        extension_configs={"mdx_steroids.img_smart": config},
+    )
+
+
+def test_missing_and_corrupt_files_load_empty(tmp_path):
+    assert len(DimensionCache(str(tmp_path / "missing.json"))) == 0
+    corrupt = tmp_path / "corrupt.json"
+    corrupt.write_text("{not json")
+    assert len(DimensionCache(str(corrupt))) == 0
+
+
+def test_flush_writes_atomically_and_only_when_dirty(tmp_path):
+    path = tmp_path / "cache.json"
+    cache = DimensionCache(str(path))
+    assert cache.flush() is False
+    assert not path.exists()
+
+    cache.set("a.png", {"media": "img", "width": 1, "height": 2})
+    assert cache.dirty
+    assert cache.flush() is True
+    assert not cache.dirty
+    assert json.loads(path.read_text()) == {
+        "a.png": {"media": "img", "width": 1, "height": 2}
+    }
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cache.json", "cache.json.lock"]
+
+
+def test_flush_merges_entries_from_other_workers(tmp_path):
+    path = str(tmp_path / "cache.json")
+    worker_a = DimensionCache(path)
+    worker_b = DimensionCache(path)
+    worker_a.set("a.png", {"media": "img", "width": 1, "height": 1})
+    worker_b.set("b.png", {"media": "img", "width": 2, "height": 2})
+    worker_a.flush()
+    worker_b.flush()
+
+    with open(path) as f:
+        assert set(json.load(f)) == {"a.png", "b.png"}
+    assert "a.png" in worker_b
+
+
+def test_flush_interval_defers_writes(tmp_path):
+    cache = DimensionCache(str(tmp_path / "cache.json"), flush_interval=3600)
+    cache.set("a.png", {"media": "img", "width": 1, "height": 1})
+    assert cache.maybe_flush() is False
+    assert cache.flush() is True
+
+
+def test_get_cache_is_shared_per_path(tmp_path):
+    path = str(tmp_path / "cache.json")
+    assert get_cache(path) is get_cache(os.path.join(str(tmp_path), ".", "cache.json"))
+
+
+def test_conversion_writes_cache_once(tmp_path, write_png):
+    for name in ("one", "two", "three"):
+        write_png(str(tmp_path / f"{name}.png"), 40, 30)
+    text = "\n\n".join(f"![{n}]({tmp_path}/{n}.png)" for n in ("one", "two", "three"))
+    cache_path = str(tmp_path / "cache.json")
+
+    with patch.object(DimensionCache, "_write", autospec=True) as write:
+        write.side_effect = lambda self, data: None
+        convert(text, cache_path)
+    assert write.call_count == 1
+    assert len(write.call_args[0][1]) == 3
+
+
+def test_conversion_reuses_cached_dimensions(tmp_path, write_png):
+    image = str(tmp_path / "image.png")
+    write_png(image, 40, 30)
+    cache_path = str(tmp_path / "cache.json")
+
+    first = convert(f"![Alt]({image})", cache_path)
+    assert 'width="40"' in first
+    os.unlink(image)
+    second = convert(f"![Alt]({image})", cache_path)
+    assert first == second
+
+
+def test_changed_file_is_reprobed(tmp_path, write_png):
+    image = str(tmp_path / "image.png")
+    write_png(image, 40, 30)
+    cache_path = str(tmp_path / "cache.json")
+
+    assert 'width="40"' in convert(f"![Alt]({image})", cache_path)
+    entry = get_cache(cache_path).get(image)
+    assert entry["media"] == "img"
+    assert entry["size"] == os.path.getsize(image)
+    assert "mtime_ns" in entry
+
+    write_png(image, 50, 30)
+    os.utime(image, ns=(entry["mtime_ns"] + 10**9, entry["mtime_ns"] + 10**9))
+    assert 'width="50"' in convert(f"![Alt]({image})", cache_path)
+
+
+def test_hash_revalidates_touched_file(tmp_path, write_png):
+    image = str(tmp_path / "image.png")
+    write_png(image, 40, 30)
+    cache_path = str(tmp_path / "cache.json")
+    convert(f"![Alt]({image})", cache_path, cache_hash=True)
+    entry = get_cache(cache_path).get(image)
+    assert entry["hash"] == img_cache.content_hash(image)
+
+    os.utime(image, ns=(entry["mtime_ns"] + 10**9, entry["mtime_ns"] + 10**9))
+    with patch("mdx_steroids.img_smart.iio.immeta") as immeta:
+        assert 'width="40"' in convert(f"![Alt]({image})", cache_path, cache_hash=True)
+    immeta.assert_not_called()
+    assert get_cache(cache_path).get(image)["mtime_ns"] == entry["mtime_ns"] + 10**9
+
+
+def _sqlite_worker(args):
+    path, worker = args
+    cache = SQLiteDimensionCache(path)
+    for i in range(50):
+        cache.set(f"{worker}-{i}.png", {"media": "img", "width": i + 1, "height": 1})
+        if i % 10 == 9:
+            cache.flush()
+    return len(cache)
+
+
+def _forked_connection(path):
+    cache = get_cache(path)
+    cache.set("child.png", {"media": "img", "width": 5, "height": 5})
+    cache.flush()
+    return id(cache), id(cache.connection), sorted(cache._pending)
+
+
+def test_sqlite_cache_reconnects_after_fork(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = get_cache(path)
+    cache.set("parent.png", {"media": "img", "width": 1, "height": 1})
+    parent_connection = cache.connection
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        cache_id, connection_id, pending = pool.apply(_forked_connection, (path,))
+    assert cache_id == id(cache)
+    assert connection_id != id(parent_connection)
+    assert pending == []
+    assert cache.connection is parent_connection
+    assert SQLiteDimensionCache(path).get("child.png")["width"] == 5
+    assert cache._pending and "parent.png" not in SQLiteDimensionCache(path)
+
+
+def test_sqlite_cache_round_trip(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = get_cache(path)
+    assert isinstance(cache, SQLiteDimensionCache)
+    cache.set("a.png", {"media": "img", "width": 1, "height": 2, "size": 3})
+    assert cache.get("a.png")["width"] == 1
+    assert cache.flush() is True
+    assert cache.flush() is False
+
+    reopened = SQLiteDimensionCache(path)
+    assert reopened.get("a.png") == {"media": "img", "width": 1, "height": 2, "size": 3}
+    assert "b.png" not in reopened
+    assert reopened.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_sqlite_cache_concurrent_workers(tmp_path):
+    path = str(tmp_path / "cache.db")
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(4) as pool:
+        pool.map(_sqlite_worker, [(path, w) for w in range(4)])
+    assert len(SQLiteDimensionCache(path)) == 200
+
+
+def test_sqlite_cache_in_extension(tmp_path, write_png):
+    image = str(tmp_path / "image.png")
+    write_png(image, 40, 30)
+    cache_path = str(tmp_path / "cache.sqlite")
+    first = convert(f"![Alt]({image})", cache_path)
+    img_cache._caches.clear()
+    assert SQLiteDimensionCache(cache_path).get(image)["width"] == 40
+    with patch("mdx_steroids.img_smart.MDXSmartImageProcessor.probe_dimensions") as probe:
+        assert convert(f"![Alt]({image})", cache_path) == first
+    probe.assert_not_called()
+
+
+def test_worker_processes_flush_on_exit(tmp_path, write_png):
+    """Test that pending entries are written when pool workers exit."""
+    images = []
+    for i in range(4):
+        images.append(str(tmp_path / f"{i}.png"))
+        write_png(images[-1], 10 + i, 10)
+    cache_path = str(tmp_path / "cache.json")
+    config = {"cache": cache_path, "cache_flush_interval": 3600}
+    html = list(
+        convert_many(
+            [f"![Alt]({image})" for image in images],
+            ["mdx_steroids.img_smart"],
+            {"mdx_steroids.img_smart": config},
+            workers=2,
+        )
+    )
+    assert all(f'width="{10 + i}"' in h for i, h in enumerate(html))
+    with open(cache_path) as f:
+        assert set(json.load(f)) == set(images)
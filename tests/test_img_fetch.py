@@ -0,0 +1,205 @@
+# this_file: tests/test_img_fetch.py
+"""Tests for remote image metadata fetching, against a local HTTP server."""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import markdown
+import pytest
+import requests
+
+from mdx_steroids import img_fetch
+from mdx_steroids.img_cache import get_cache
+from mdx_steroids.img_probe import ProbeResult
+from mdx_steroids.img_smart import MDXSmartImageExtension, MDXSmartImageProcessor
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve `server.files`, honoring `Range: bytes=0-N` like a CDN would."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        status = 200
+        rng = self.headers.get("Range")
+        if rng and self.server.honor_range:
+            start, end = rng.split("=")[1].split("-")
+            body = body[int(start) : int(end) + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.files = {}
+    httpd.requests = []
+    httpd.honor_range = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_probe_requests_a_range(server, pil_image):
+    server.files["/a.png"] = pil_image("PNG", size=(300, 200))
+    info, head, complete = img_fetch.fetch_probe(server.url + "/a.png", size=1024)
+    assert info == ProbeResult("img", 300, 200)
+    assert server.requests == [("/a.png", "bytes=0-1023")]
+
+
+def test_fetch_probe_continues_within_budget(server, pil_image):
+    server.files["/a.png"] = pil_image("PNG", size=(300, 200))
+    info, head, complete = img_fetch.fetch_probe(
+        server.url + "/a.png", size=16, max_bytes=4096
+    )
+    assert info == ProbeResult("img", 300, 200)
+    assert [r[1] for r in server.requests] == ["bytes=0-15", "bytes=16-4095"]
+
+
+def test_fetch_probe_stops_early_without_range_support(server, pil_image):
+    server.honor_range = False
+    png = pil_image("PNG", size=(300, 200))
+    server.files["/big.png"] = png + b"\x00" * 5000000
+    info, head, complete = img_fetch.fetch_probe(server.url + "/big.png")
+    assert info == ProbeResult("img", 300, 200)
+    assert len(head) < 100000
+    assert not complete
+
+
+def test_fetch_probe_caps_unknown_formats(server):
+    server.honor_range = False
+    server.files["/big.bin"] = b"\x00" * 500000
+    info, head, complete = img_fetch.fetch_probe(
+        server.url + "/big.bin", size=1000, max_bytes=20000
+    )
+    assert info is None
+    assert len(head) == 20000
+    assert not complete
+
+
+def test_fetch_probe_reports_small_files_complete(server):
+    server.files["/small.bin"] = b"\x01" * 100
+    info, head, complete = img_fetch.fetch_probe(server.url + "/small.bin")
+    assert (info, len(head), complete) == (None, 100, True)
+
+
+def test_fetch_probe_raises_on_http_errors(server):
+    with pytest.raises(requests.HTTPError):
+        img_fetch.fetch_probe(server.url + "/missing.png")
+
+
+def test_prefetch_measures_concurrently(server, pil_image):
+    urls = []
+    for i in range(10):
+        server.files[f"/{i}.png"] = pil_image("PNG", size=(100 + i, 50))
+        urls.append(f"{server.url}/{i}.png")
+    urls.append(server.url + "/missing.png")
+
+    results = img_fetch.prefetch(urls + urls[:3], workers=4)
+    assert len(results) == 11
+    assert results[urls[3]].info == ProbeResult("img", 103, 50)
+    assert results[urls[3]].error is None
+    missing = results[server.url + "/missing.png"]
+    assert missing.info is None
+    assert isinstance(missing.error, requests.HTTPError)
+    assert len(server.requests) == 11
+
+
+def test_prefetch_extension_option(server, pil_image):
+    server.files["/wide.png"] = pil_image("PNG", size=(1200, 600))
+    server.files["/small.jpg"] = pil_image("JPEG", size=(60, 40))
+    text = f"![Wide]({server.url}/wide.png)\n\n![Small]({server.url}/small.jpg)"
+    html = markdown.markdown(
+        text,
+        extensions=["mdx_steroids.img_smart"],
+        extension_configs={"mdx_steroids.img_smart": {"prefetch": True}},
+    )
+    assert 'width="600"' in html
+    assert 'width="60"' in html
+    assert sorted(r[0] for r in server.requests) == ["/small.jpg", "/wide.png"]
+    assert all(r[1] == "bytes=0-65535" for r in server.requests)
+
+
+def test_unknown_prefetched_format_is_probed_from_its_bytes(
+    server, tmp_path, pil_image
+):
+    server.files["/odd.tif"] = pil_image("TIFF", size=(60, 40))
+    url = server.url + "/odd.tif"
+    cache_path = str(tmp_path / "cache.json")
+    config = {"prefetch": True, "cache": cache_path, "fetch_failure_ttl": 3600}
+    html = markdown.markdown(
+        f"![Odd]({url})",
+        extensions=["mdx_steroids.img_smart"],
+        extension_configs={"mdx_steroids.img_smart": config},
+    )
+    assert 'width="60"' in html
+    assert get_cache(cache_path).get(url)["width"] == 60
+    assert len(server.requests) == 1
+
+
+def test_failed_prefetch_is_not_fetched_again(server, tmp_path):
+    url = server.url + "/missing.png"
+    cache_path = str(tmp_path / "cache.json")
+    config = {"prefetch": True, "cache": cache_path, "fetch_failure_ttl": 3600}
+    with patch.object(MDXSmartImageProcessor, "probe_dimensions") as probe_dimensions:
+        markdown.markdown(
+            f"![Missing]({url})",
+            extensions=["mdx_steroids.img_smart"],
+            extension_configs={"mdx_steroids.img_smart": config},
+        )
+    probe_dimensions.assert_not_called()
+    assert server.requests == [("/missing.png", "bytes=0-65535")]
+    entry = get_cache(cache_path).get(url)
+    assert entry["width"] == 0 and entry["expires"] > time.time()
+
+
+def test_prefetch_documents_batch(server, pil_image):
+    docs = []
+    for name in ("one", "two"):
+        server.files[f"/{name}.gif"] = pil_image("GIF", size=(80, 40))
+        docs.append(f"# {name}\n\n![{name}]({server.url}/{name}.gif)\n")
+    ext = MDXSmartImageExtension()
+    md = markdown.Markdown(extensions=[ext])
+    ext.prefetch_documents(docs)
+    assert len(server.requests) == 2
+
+    for doc in docs:
+        assert 'width="40"' in md.reset().convert(doc)
+    assert len(server.requests) == 2
+
+
+def test_failures_are_cached_with_ttl(server, tmp_path):
+    cache_path = str(tmp_path / "cache.json")
+    text = f"![Broken]({server.url}/broken.png)"
+    config = {"cache": cache_path, "fetch_failure_ttl": 3600}
+    for _ in range(2):
+        markdown.markdown(
+            text,
+            extensions=["mdx_steroids.img_smart"],
+            extension_configs={"mdx_steroids.img_smart": config},
+        )
+    assert len(server.requests) == 1
+
+    entry = get_cache(cache_path).get(server.url + "/broken.png")
+    assert entry["width"] == 0
+    entry["expires"] = time.time() - 1
+    markdown.markdown(
+        text,
+        extensions=["mdx_steroids.img_smart"],
+        extension_configs={"mdx_steroids.img_smart": config},
+    )
+    assert len(server.requests) == 2
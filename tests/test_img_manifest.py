@@ -0,0 +1,107 @@
+# this_file: tests/test_img_manifest.py
+"""Tests for img_smart dimension manifests."""
+
+import json
+import multiprocessing
+from unittest.mock import patch
+
+import markdown
+import pytest
+
+from mdx_steroids.img_manifest import (
+    MissingImageError,
+    load_manifest,
+    main,
+    scan,
+    write_manifest,
+)
+
+ENTRIES = {
+    "img/wide.png": {"media": "img", "width": 1200, "height": 600},
+    "https://cdn.example.com/clip.mp4": {"media": "video", "width": 640, "height": 360},
+}
+
+
+def convert(text, **config):
+    return markdown.markdown(
+        text,
+        extensions=["mdx_steroids.img_smart"],
+        extension_configs={"mdx_steroids.img_smart": config},
+    )
+
+
+@pytest.mark.parametrize("suffix", [".json", ".csv", ".sqlite"])
+def test_round_trip(tmp_path, suffix):
+    path = str(tmp_path / ("manifest" + suffix))
+    write_manifest(path, ENTRIES)
+    manifest = load_manifest(path)
+    assert len(manifest) == 2
+    for key, entry in ENTRIES.items():
+        assert manifest.get(key) == entry
+    assert manifest.get("missing.png") is None
+    assert load_manifest(path) is manifest
+
+
+def _forked_lookup(path):
+    manifest = load_manifest(path)
+    return id(manifest.connection), manifest.get("img/wide.png")
+
+
+def test_sqlite_manifest_reconnects_after_fork(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    write_manifest(path, ENTRIES)
+    manifest = load_manifest(path)
+    parent_connection = manifest.connection
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        connection_id, entry = pool.apply(_forked_lookup, (path,))
+    assert connection_id != id(parent_connection)
+    assert entry == ENTRIES["img/wide.png"]
+
+
+def test_json_record_list(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps([{"path": "a.gif", "media": "img", "width": 3, "height": 4}]))
+    assert load_manifest(str(path)).get("a.gif") == {"media": "img", "width": 3, "height": 4}
+
+
+@pytest.mark.parametrize("suffix", [".json", ".sqlite"])
+def test_manifest_is_the_only_source(tmp_path, suffix):
+    path = str(tmp_path / ("manifest" + suffix))
+    write_manifest(path, ENTRIES)
+    text = (
+        "![Wide](/assets/wide.png)\n\n"
+        "![Clip](https://cdn.example.com/clip.mp4)\n\n"
+        "![Unknown](/assets/unknown.png)"
+    )
+    with patch("mdx_steroids.img_smart.MDXSmartImageProcessor.probe_dimensions") as probe:
+        html = convert(text, manifest=path, find="/assets/", repl_path="img/")
+    probe.assert_not_called()
+    assert 'width="600"' in html
+    assert 'width="320"' in html
+    assert 'src="/assets/unknown.png"' in html
+
+
+def test_strict_manifest_raises_on_miss(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    write_manifest(path, ENTRIES)
+    with pytest.raises(MissingImageError):
+        convert("![Unknown](unknown.png)", manifest=path, manifest_strict=True)
+
+
+def test_scan_and_cli(tmp_path, write_png):
+    root = tmp_path / "site" / "img"
+    (root / "sub").mkdir(parents=True)
+    write_png(root / "a.png", 10, 20)
+    write_png(root / "sub" / "b.png", 30, 40)
+    (root / "notes.txt").write_text("not an image")
+
+    entries, skipped = scan(str(root), prefix="img/", workers=2)
+    assert entries == {
+        "img/a.png": {"media": "img", "width": 10, "height": 20},
+        "img/sub/b.png": {"media": "img", "width": 30, "height": 40},
+    }
+    assert skipped == ["img/notes.txt"]
+
+    output = str(tmp_path / "manifest.csv")
+    assert main([str(root), "-o", output, "--prefix", "img/", "-j", "2"]) == 0
+    assert load_manifest(output).get("img/sub/b.png")["width"] == 30
@@ -0,0 +1,121 @@
+# this_file: tests/test_img_probe.py
+"""Tests for header-only dimension sniffing."""
+
+import io
+import struct
+
+import pytest
+
+from mdx_steroids.img_probe import ProbeResult, Reader, probe, probe_reader
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def full_box(kind, payload=b"", version=0):
+    return box(kind, bytes([version, 0, 0, 0]) + payload)
+
+
+def tkhd(width, height, version=0):
+    times = b"\x00" * (32 if version == 1 else 20)
+    rest = b"\x00" * 52 + struct.pack(">II", width << 16, height << 16)
+    return full_box(b"tkhd", times + rest, version)
+
+
+def ebml(element_id, payload):
+    size = len(payload)
+    return element_id + bytes([0x40 | (size >> 8), size & 0xFF]) + payload
+
+
+@pytest.mark.parametrize(
+    "fmt,kwargs",
+    [
+        ("PNG", {}),
+        ("JPEG", {}),
+        ("JPEG", {"progressive": True}),
+        ("GIF", {}),
+        ("BMP", {}),
+        ("WEBP", {"lossless": True}),
+        ("WEBP", {"quality": 50}),
+    ],
+)
+def test_raster_formats(fmt, kwargs, pil_image):
+    assert probe(pil_image(fmt, **kwargs)) == ProbeResult("img", 123, 45)
+
+
+def test_webp_extended():
+    data = b"RIFF\x00\x00\x00\x00WEBPVP8X" + struct.pack("<I", 10) + b"\x00" * 4
+    data += (639).to_bytes(3, "little") + (479).to_bytes(3, "little")
+    assert probe(data) == ProbeResult("img", 640, 480)
+
+
+def test_jpeg_reads_only_headers(pil_image):
+    data = pil_image("JPEG", size=(800, 600))
+    reader = Reader(io.BytesIO(data))
+    assert probe_reader(reader) == ProbeResult("img", 800, 600)
+    assert reader.bytes_read < 1024 < len(data)
+
+
+def test_avif_ispe():
+    ftyp = box(b"ftyp", b"avif\x00\x00\x00\x00avifmif1")
+    ipco = box(
+        b"ipco",
+        full_box(b"ispe", struct.pack(">II", 160, 90))
+        + full_box(b"ispe", struct.pack(">II", 1920, 1080)),
+    )
+    meta = full_box(b"meta", full_box(b"hdlr", b"\x00" * 20) + box(b"iprp", ipco))
+    assert probe(ftyp + meta) == ProbeResult("img", 1920, 1080)
+
+
+@pytest.mark.parametrize("version", [0, 1])
+def test_mp4_tkhd_after_mdat(version):
+    ftyp = box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41")
+    mdat = box(b"mdat", b"\x00" * 100000)
+    audio = box(b"trak", tkhd(0, 0, version))
+    video = box(b"trak", tkhd(1280, 720, version))
+    data = ftyp + mdat + box(b"moov", full_box(b"mvhd", b"\x00" * 96) + audio + video)
+    reader = Reader(io.BytesIO(data))
+    assert probe_reader(reader) == ProbeResult("video", 1280, 720)
+    assert reader.bytes_read < 1024
+
+
+def test_webm_tracks():
+    header = ebml(b"\x1a\x45\xdf\xa3", ebml(b"\x42\x82", b"webm"))
+    audio = ebml(b"\xae", ebml(b"\xd7", b"\x01"))
+    video = ebml(
+        b"\xae",
+        ebml(b"\xd7", b"\x02")
+        + ebml(b"\xe0", ebml(b"\xb0", b"\x03\x20") + ebml(b"\xba", b"\x02\x58")),
+    )
+    segment = ebml(
+        b"\x18\x53\x80\x67",
+        ebml(b"\x15\x49\xa9\x66", b"\x00" * 10) + ebml(b"\x16\x54\xae\x6b", audio + video),
+    )
+    assert probe(header + segment) == ProbeResult("video", 800, 600)
+
+
+@pytest.mark.parametrize(
+    "svg,expected",
+    [
+        (b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 50">', (100, 50)),
+        (b'<?xml version="1.0"?>\n<svg viewBox="10,10,24.4,12">', (24, 12)),
+        (b'<svg width="300px" height="200"></svg>', (300, 200)),
+    ],
+)
+def test_svg(svg, expected):
+    assert probe(svg + b"</svg>") == ProbeResult("svg", *expected)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"fake image data",
+        b"\x89PNG\r\n\x1a\n\x00\x00",
+        b"\xff\xd8\xff\xe0\x00\x10JFIF",
+        b"<html><body>Not found</body></html>",
+    ],
+)
+def test_unknown_or_truncated(data):
+    assert probe(data) is None
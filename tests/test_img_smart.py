@@ -6,6 +6,7 @@ import pytest
 import tempfile
 import os
 import json
+import logging
 from unittest.mock import patch, MagicMock
 
 
@@ -188,12 +189,15 @@ class TestImgSmartExtension:
         assert '<img' not in html
         assert text in html
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_remote_image_dimensions(self, mock_get):
         """Test fetching dimensions for remote images."""
         # Mock response for remote image
         mock_response = MagicMock()
-        mock_response.content = b'fake image data'
+        mock_response.__enter__.return_value = mock_response
+        mock_response.status_code = 200
+        mock_response.headers = {}
+        mock_response.iter_content.return_value = [b'fake image data']
         mock_get.return_value = mock_response
         
         text = "![Remote](https://example.com/image.jpg)"
@@ -224,4 +228,59 @@ Some text between images.
         )
         assert '<h1>Gallery</h1>' in html
         assert html.count('<img') == 3
-        assert 'List item with' in html
\ No newline at end of file
+        assert 'List item with' in html
+
+    def test_metrics_and_summary_log(self, tmp_path, caplog):
+        """Test cache hit/miss counters and the per-conversion summary."""
+        from mdx_steroids.img_smart import MDXSmartImageExtension
+
+        image = tmp_path / "a.gif"
+        image.write_bytes(b"GIF89a" + bytes([40, 0, 20, 0]) + b"\x00" * 16)
+        ext = MDXSmartImageExtension(cache=str(tmp_path / "cache.json"))
+        md = markdown.Markdown(extensions=[ext])
+        with caplog.at_level("DEBUG", logger="mdx_steroids.img_smart"):
+            md.convert(f"![A]({image})")
+            md.reset().convert(f"![A]({image})")
+        metrics = ext.metrics.as_dict()
+        assert (metrics["cache_hits"], metrics["cache_misses"]) == (1, 1)
+        assert metrics["probes"] == 1
+        assert 0 < metrics["bytes_read"] < 100
+        assert sum(metrics["latency"].values()) == 1
+        summaries = [
+            r.getMessage() for r in caplog.records if "conversion:" in r.getMessage()
+        ]
+        assert len(summaries) == 2
+        assert "0 cache hits, 1 misses, 1 probes" in summaries[0]
+        assert "1 cache hits, 0 misses, 0 probes" in summaries[1]
+
+    @pytest.mark.parametrize("level", [logging.INFO, "info", "INFO"])
+    def test_log_level_name_or_number(self, tmp_path, caplog, level):
+        """Test that log_level accepts a level number or a known name."""
+        from mdx_steroids.img_smart import MDXSmartImageExtension
+
+        ext = MDXSmartImageExtension(log_level=level)
+        with caplog.at_level("INFO", logger="mdx_steroids.img_smart"):
+            markdown.Markdown(extensions=[ext]).convert("Text")
+        assert [r.levelno for r in caplog.records] == [logging.INFO]
+
+    def test_unknown_log_level(self):
+        """Test that an unknown log_level name is rejected at setup."""
+        from mdx_steroids.img_smart import MDXSmartImageExtension
+
+        with pytest.raises(ValueError, match="verbose"):
+            markdown.Markdown(extensions=[MDXSmartImageExtension(log_level="verbose")])
+
+    def test_warnings_are_rate_limited(self, tmp_path, caplog):
+        """Test that only log_limit warnings are logged per conversion."""
+        from mdx_steroids.img_smart import MDXSmartImageExtension
+
+        page = tmp_path / "404.png"
+        page.write_bytes(b"<html><body>Not found</body></html>")
+        ext = MDXSmartImageExtension(log_limit=2, log_level="INFO")
+        text = "\n\n".join(f"![{i}]({page})" for i in range(5))
+        with caplog.at_level("INFO", logger="mdx_steroids.img_smart"):
+            markdown.Markdown(extensions=[ext]).convert(text)
+        warnings = [r for r in caplog.records if r.levelname == "WARNING"]
+        assert len(warnings) == 2
+        assert ext.metrics.suppressed == 3
+        assert "3 warnings suppressed" in caplog.text
@@ -1,4 +1,6 @@
 # this_file: tests/test_kill_tags.py
+from unittest.mock import patch
+
 import markdown
 import pytest
 
@@ -240,4 +242,223 @@ def test_kill_tags_multiple_instances():
     assert "Ad 2" not in html_output
     # Should keep regular content
     assert "Content" in html_output
-    assert "More content" in html_output
\ No newline at end of file
+    assert "More content" in html_output
+
+
+def test_kill_tags_union_keeps_tails():
+    """Test that merged selectors remove nested matches and keep tails."""
+    md_input = (
+        '<div class="box">Intro <del>gone</del> after del '
+        '<span class="ad">ad <b>bold</b> more</span> tail '
+        "<em>kept</em></div>"
+    )
+    config = {"kill": ["del", ".ad", "b", "span b", "!//del"], "kill_empty": []}
+
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.kill_tags"],
+        extension_configs={"mdx_steroids.kill_tags": config},
+    )
+    html_output = md.convert(md_input)
+
+    assert html_output == (
+        '<div class="box">Intro  after del  tail <em>kept</em></div>'
+    )
+
+
+def test_kill_tags_single_query():
+    """Test that all kill selectors are matched by one compiled XPath."""
+    from mdx_steroids.kill_tags import KillTagsExtension
+
+    config = {"kill": ["del", ".ad", "#x", "pre > code.language-del"], "kill_known": True}
+    md = markdown.Markdown(extensions=[KillTagsExtension(**config)])
+    processor = md.postprocessors["steroids_dom"].processors["kill_tags"]
+    assert processor.kill.path.count(" | ") == 5
+    assert {"p", "div"} <= processor.kill_empty
+
+
+EMPTY_HTML = (
+    "<div><p> </p><p><b></b></p><p><img src='a.png'></p>"
+    "<div><p></p>text</div><ul><li><p></p></li><li>x</li></ul>"
+    "<div class='keep'></div><blockquote><div> <p></p> </div></blockquote>"
+    "<p>&nbsp;</p><div>\t\r\n</div></div>"
+)
+
+
+def kill_empty(html, **config):
+    import lxml.html
+
+    from mdx_steroids.kill_tags import KillTagsPostprocessor
+
+    processor = KillTagsPostprocessor(markdown.Markdown())
+    processor.config = dict({"kill_empty": ["p", "div"]}, **config)
+    tree = lxml.html.fromstring(html)
+    processor.run_tree(tree)
+    return lxml.html.tostring(tree, encoding="unicode")
+
+
+def test_kill_empty_matches_xpath_definition():
+    """Test that the bottom-up pass removes what the XPath test selected."""
+    import lxml.html
+
+    from mdx_steroids.kill_tags import KillTagsPostprocessor
+
+    processor = KillTagsPostprocessor(markdown.Markdown())
+    tree = lxml.html.fromstring(EMPTY_HTML)
+    root = tree.getroottree().getroot()
+    for el in tree.xpath(
+        "//*[self::p or self::div]["
+        "not(descendant-or-self::*/text()[normalize-space()])"
+        " and not(descendant-or-self::*/attribute::*)]"
+    ):
+        if el.getroottree().getroot() is root:
+            processor.remove_keeping_tail(el)
+    expected = lxml.html.tostring(tree, encoding="unicode")
+
+    assert kill_empty(EMPTY_HTML) == expected
+    assert kill_empty(EMPTY_HTML) == (
+        "<div><p><img src=\"a.png\"></p><div>text</div>"
+        "<ul><li><li>x</li></ul><div class=\"keep\"></div>"
+        "<blockquote></blockquote><p>\xa0</p></div>"
+    )
+
+
+def test_kill_empty_cascade():
+    """Test that kill_empty_cascade removes elements left empty."""
+    assert kill_empty(EMPTY_HTML, kill_empty_cascade=True) == (
+        "<div><p><img src=\"a.png\"></p><div>text</div>"
+        "<ul><li>x</li></ul><div class=\"keep\"></div><p>\xa0</p></div>"
+    )
+
+
+def test_kill_empty_deep_nesting():
+    """Test nested empty blocks next to nested content."""
+    nested = "<div>" * 200 + "{}" + "</div>" * 200
+    html = "<div>" + nested.format("<p></p>") + nested.format("<p>x</p>") + "</div>"
+    assert kill_empty(html) == "<div>" + nested.format("<p>x</p>") + "</div>"
+
+
+STREAM_INPUT = """# Title
+
+Some <del>deleted <b>bold</b></del> tail and ü &amp; <span class="ad x">ad</span> end.
+
+<div><p></p></div>
+
+```
+<code>&lt;kept&gt;</code>
+```
+
+- item <del>x</del>
+- <p class="ad"></p>
+
+<p class="keep"></p>
+"""
+
+
+def test_kill_tags_stream_matches_regular_mode():
+    """Test that streaming removes the same elements as the DOM stage."""
+    output = {}
+    for stream in (False, True):
+        md = markdown.Markdown(
+            extensions=["mdx_steroids.kill_tags"],
+            extension_configs={
+                "mdx_steroids.kill_tags": {
+                    "kill": ["del", ".ad", "ul > li > b"],
+                    "stream": stream,
+                }
+            },
+        )
+        output[stream] = md.convert(STREAM_INPUT)
+    assert "steroids_dom" not in md.postprocessors
+    # Markdown strips the output, which removes the newline outside the <div>
+    assert "<div>" + output[True] + "\n</div>" == output[False]
+    assert "deleted" not in output[True]
+    assert '<p class="keep"/>' in output[True]
+
+
+def test_kill_empty_cascade_same_in_all_modes():
+    """Test that only children removed as empty make a parent cascade."""
+    text = (
+        "* <del>gone</del>\n* kept\n\n"
+        "<ul><li><p></p></li><li>x</li></ul>\n\n> <p></p>\n"
+    )
+    output = {}
+    for mode in ({}, {"stream": True}, {"mode": "tree"}):
+        config = dict(kill=["del"], kill_empty=["p"], kill_empty_cascade=True)
+        config.update(mode)
+        html = markdown.markdown(
+            text,
+            extensions=["mdx_steroids.kill_tags"],
+            extension_configs={"mdx_steroids.kill_tags": config},
+        )
+        output[str(mode)] = html.replace("<div>", "").replace("</div>", "").strip()
+    assert len(set(output.values())) == 1, output
+    assert output["{}"] == "<ul>\n<li/>\n<li>kept</li>\n</ul>\n<ul><li>x</li></ul>"
+
+
+def test_kill_tags_stream_falls_back():
+    """Test that selectors the stream cannot test use the DOM stage."""
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.kill_tags"],
+        extension_configs={
+            "mdx_steroids.kill_tags": {"kill": ["h1 + p"], "stream": True}
+        },
+    )
+    assert "kill_tags" in md.postprocessors["steroids_dom"].processors
+    assert "Some" not in md.convert(STREAM_INPUT)
+
+
+def test_kill_tags_stream_frees_completed_blocks():
+    """Test that the parsed tree only holds a few top-level elements."""
+    from mdx_steroids import kill_tags
+
+    sizes = []
+    flush = kill_tags.KillTagsStreamPostprocessor.flush
+
+    def recording_flush(self, parent, upto=None):
+        sizes.append(len(parent))
+        flush(self, parent, upto)
+
+    text = "\n\n".join(f"Paragraph {i} <del>gone</del>." for i in range(2000))
+    with patch.object(kill_tags, "STREAM_CHUNK_SIZE", 1024), patch.object(
+        kill_tags.KillTagsStreamPostprocessor, "flush", recording_flush
+    ):
+        html = markdown.markdown(
+            text,
+            extensions=["mdx_steroids.kill_tags"],
+            extension_configs={"mdx_steroids.kill_tags": {"kill": ["del"], "stream": True}},
+        )
+    assert html.count("<p>") == 2000 and "gone" not in html
+    assert max(sizes) < 50
+
+
+def test_kill_tags_tree_mode():
+    """Test removal from the Markdown tree, without parsing the HTML."""
+    import lxml.html
+
+    md_input = "# Title\n\nKeep ~~drop~~ this\n\n> ~~all~~\n\n* a ~~b~~ c\n"
+    config = {"kill": ["del"], "mode": "tree", "kill_empty_cascade": True}
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.kill_tags", "pymdownx.tilde"],
+        extension_configs={"mdx_steroids.kill_tags": config},
+    )
+    with patch("lxml.html.fromstring", wraps=lxml.html.fromstring) as parse:
+        html_output = md.convert(md_input)
+    parse.assert_not_called()
+    assert html_output == (
+        "<h1>Title</h1>\n<p>Keep  this</p>\n<ul>\n<li>a  c</li>\n</ul>"
+    )
+
+
+def test_kill_tags_tree_mode_raw_html():
+    """Test that raw HTML goes through the postprocessor in tree mode."""
+    md_input = "Text <del>raw</del> tail.\n\n<div><p></p></div>\n\n```\n<del>code</del>\n```\n"
+    output = {}
+    for mode in ("postprocessor", "tree"):
+        md = markdown.Markdown(
+            extensions=["mdx_steroids.kill_tags", "fenced_code"],
+            extension_configs={"mdx_steroids.kill_tags": {"kill": ["del"], "mode": mode}},
+        )
+        output[mode] = md.convert(md_input)
+    assert output["tree"] == output["postprocessor"]
+    assert "raw" not in output["tree"] and "<div>" not in output["tree"][5:]
+    assert "&lt;del&gt;code&lt;/del&gt;" in output["tree"]
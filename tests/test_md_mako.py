@@ -5,6 +5,10 @@ import markdown
 import pytest
 import tempfile
 import os
+import re
+from unittest.mock import patch
+
+from mdx_steroids import md_mako
 
 
 class TestMdMakoExtension:
@@ -230,4 +234,156 @@ Total items: ${len(items)}
                     }
                 }
             )
-            assert "Welcome to My Site!" in html
\ No newline at end of file
+            assert "Welcome to My Site!" in html
+
+
+class TestTemplateCache:
+    """Test the compiled template cache."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        md_mako._templates.clear()
+        yield
+        md_mako._templates.clear()
+
+    def test_unchanged_source_is_compiled_once(self):
+        md = markdown.Markdown(
+            extensions=['mdx_steroids.md_mako'],
+            extension_configs={'mdx_steroids.md_mako': {'meta': {'n': 1}}},
+        )
+        with patch.object(md_mako, "Template", wraps=md_mako.Template) as template:
+            first = md.convert("# Title\n\nn = ${n}")
+            second = md.reset().convert("# Title\n\nn = ${n}")
+            md.reset().convert("# Other\n\nn = ${n}")
+        assert first == second == "<h1>Title</h1>\n<p>n = 1</p>"
+        assert template.call_count == 2
+        assert len(md_mako._templates) == 2
+
+    def test_module_directory_reused_across_processes(self, tmp_path):
+        configs = {'mdx_steroids.md_mako': {'module_directory': str(tmp_path)}}
+        text = "## Sum\n\n${1 + 2}"
+        html = markdown.markdown(
+            text, extensions=['mdx_steroids.md_mako'], extension_configs=configs
+        )
+        assert len(list(tmp_path.glob("md_mako_*.py"))) == 1
+
+        md_mako._templates.clear()  # as in a new process
+        with patch.object(md_mako, "Template", wraps=md_mako.Template) as template:
+            again = markdown.markdown(
+                text, extensions=['mdx_steroids.md_mako'], extension_configs=configs
+            )
+        assert again == html == "<h2>Sum</h2>\n<p>3</p>"
+        assert template.call_count == 0
+
+
+class TestTemplateLookup:
+    """Test the lookup shared by the documents of an extension instance."""
+
+    @pytest.mark.parametrize("filesystem_checks", [True, False])
+    def test_included_template_compiled_once(self, tmp_path, filesystem_checks):
+        head = tmp_path / "head.md"
+        head.write_text("Version 1")
+        md = markdown.Markdown(
+            extensions=['mdx_steroids.md_mako'],
+            extension_configs={
+                'mdx_steroids.md_mako': {
+                    'include_base': str(tmp_path),
+                    'filesystem_checks': filesystem_checks,
+                }
+            },
+        )
+        text = '<%include file="head.md"/>\n\nPage'
+        lookup = md.preprocessors["md_mako"].lookup
+        outputs = []
+        with patch.object(lookup, "_load", wraps=lookup._load) as load:
+            for _ in range(3):
+                outputs.append(md.reset().convert(text))
+            head.write_text("Version 2")
+            stat = head.stat()
+            os.utime(head, (stat.st_atime, stat.st_mtime + 10))
+            outputs.append(md.reset().convert(text))
+        assert outputs[:3] == ["<p>Version 1</p>\n<p>Page</p>"] * 3
+        if filesystem_checks:
+            assert load.call_count == 2
+            assert outputs[3] == "<p>Version 2</p>\n<p>Page</p>"
+        else:
+            assert load.call_count == 1
+            assert outputs[3] == "<p>Version 1</p>\n<p>Page</p>"
+
+
+class TestPythonBlock:
+    """Test the python_block module loaded once per file version."""
+
+    def test_loaded_once_and_reloaded_on_change(self, tmp_path):
+        head = tmp_path / "head.py"
+        head.write_text("import math\n\ndef area(r):\n    return round(math.pi * r * r)\n")
+        md = markdown.Markdown(
+            extensions=['mdx_steroids.md_mako'],
+            extension_configs={'mdx_steroids.md_mako': {'python_block': str(head)}},
+        )
+        text = "Area ${area(2)}"
+        with patch.object(md_mako, "compile", wraps=compile, create=True) as comp:
+            outputs = [md.reset().convert(text) for _ in range(3)]
+            head.write_text("def area(r):\n    return 4 * r * r\n")
+            stat = head.stat()
+            os.utime(head, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            outputs.append(md.reset().convert(text))
+        assert outputs == ["<p>Area 13</p>"] * 3 + ["<p>Area 16</p>"]
+        assert comp.call_count == 2
+
+    def test_underscore_names_reach_templates(self, tmp_path):
+        head = tmp_path / "head.py"
+        head.write_text(
+            "from gettext import gettext as _\n\n"
+            "def _helper(s):\n    return s.upper()\n"
+        )
+        html = markdown.markdown(
+            "${_('Hello')} ${_helper('world')}",
+            extensions=['mdx_steroids.md_mako'],
+            extension_configs={'mdx_steroids.md_mako': {'python_block': str(head)}},
+        )
+        assert html == "<p>Hello WORLD</p>"
+        assert "__builtins__" not in md_mako.load_python_block(str(head))
+
+
+def test_keep_markdown_headings_single_pass():
+    """One combined pass escapes what the three former passes did."""
+    text = "# A\n## B\n###\n{%\n%}\nx ## y\n {%\n%}%}\n#{%\n"
+    expected = text
+    for pattern in (r"^([#]+)", r"^({%)", r"^(%})"):
+        expected = re.sub(pattern, r"${'\1'}", expected, flags=re.M)
+    assert md_mako.MakoPreprocessor.keep_markdown_headings(text) == expected
+
+
+class TestRenderMany:
+    """Test batch rendering across worker processes."""
+
+    @pytest.fixture
+    def config(self, tmp_path):
+        (tmp_path / "head.md").write_text("<% site = 'Docs' %>")
+        (tmp_path / "head.py").write_text("def shout(s):\n    return s.upper()\n")
+        return {
+            'include_base': str(tmp_path),
+            'include_auto': 'head.md',
+            'python_block': 'head.py',
+            'meta': {'author': 'Ann'},
+        }
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_order_and_meta(self, config, workers, tmp_path):
+        path = tmp_path / "page.md"
+        path.write_text("# ${shout('file')}")
+        sources = [f"## Page {i} by ${{author}}" for i in range(12)]
+        sources += [("${shout(author)}", {'author': 'Bob'}), path]
+        rendered = list(md_mako.render_many(sources, config, workers=workers))
+        assert rendered[:12] == [f"## Page {i} by Ann" for i in range(12)]
+        assert rendered[12:] == ["BOB", "# FILE"]
+
+    def test_preload_compiles_include_auto(self, config):
+        renderer = md_mako.MakoPreprocessor(
+            md_mako.MarkdownMakoExtension(**config).getConfigs(), None
+        )
+        renderer.preload()
+        with patch.object(renderer.lookup, "_load") as load:
+            assert renderer.render(["${shout(author)}"]) == ["ANN"]
+        load.assert_not_called()
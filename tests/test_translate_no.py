@@ -212,4 +212,71 @@ def test_translate_no_empty_config():
     
     # Should not add translate="no" if no selectors
     assert "code" in html_output
-    assert "text" in html_output
\ No newline at end of file
+    assert "text" in html_output
+
+
+def test_translate_no_tree_mode():
+    """Test tagging in the Markdown tree, without parsing the HTML."""
+    from unittest.mock import patch
+
+    import lxml.html
+
+    md_input = "# Title\n\nSome `code` here.\n\n    block\n"
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.translate_no"],
+        extension_configs={"mdx_steroids.translate_no": {"mode": "tree"}},
+    )
+    with patch("lxml.html.fromstring", wraps=lxml.html.fromstring) as parse:
+        html_output = md.convert(md_input)
+    parse.assert_not_called()
+    assert '<code translate="no" class="notranslate">code</code>' in html_output
+    assert '<pre translate="no" class="notranslate">' in html_output
+    assert "<h1>Title</h1>" in html_output
+
+
+@pytest.mark.parametrize(
+    "md_input",
+    [
+        "# Title\n\nSome `code` here.\n\n    block\n",
+        "Text `a` and `b`{: .x #y data-z=1 }\n\n*   `in list`\n",
+        "[link](a.html){: .x rel=r }\n\n`z`{: translate=yes title=t }\n",
+    ],
+)
+def test_translate_no_tree_mode_matches_postprocessor(md_input):
+    """Test that both modes produce exactly the same HTML."""
+    add = ["code", "pre", ".x"]
+    outputs = []
+    for mode in ("postprocessor", "tree"):
+        md = markdown.Markdown(
+            extensions=["attr_list", "mdx_steroids.translate_no"],
+            extension_configs={"mdx_steroids.translate_no": {"add": add, "mode": mode}},
+        )
+        html = md.convert(md_input)
+        # lxml wraps documents of several top-level elements in a <div>
+        if html.startswith("<div>") and html.endswith("</div>"):
+            html = html[len("<div>") : -len("</div>")]
+        outputs.append(html)
+    assert 'translate="no"' in outputs[0]
+    assert outputs[1] == outputs[0]
+
+
+def test_translate_no_tree_mode_fallback():
+    """Test that raw HTML and unsupported selectors use the postprocessor."""
+    md_input = "Text with <kbd>Ctrl</kbd>.\n\n* one\n* two\n"
+    config = {"add": ["kbd", "li:first-child"], "mode": "tree"}
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.translate_no"],
+        extension_configs={"mdx_steroids.translate_no": config},
+    )
+    html_output = md.convert(md_input)
+    assert '<kbd translate="no" class="notranslate">Ctrl</kbd>' in html_output
+    assert '<li translate="no" class="notranslate">one</li>' in html_output
+    assert "<li>two</li>" in html_output
+
+    config["add"] = ["kbd"]
+    md = markdown.Markdown(
+        extensions=["mdx_steroids.translate_no"],
+        extension_configs={"mdx_steroids.translate_no": config},
+    )
+    assert 'translate="no"' in md.convert(md_input)
+    assert md.reset().convert("* one\n* two") == "<ul>\n<li>one</li>\n<li>two</li>\n</ul>"